@@ -0,0 +1,336 @@
+"""
+Offline benchmark / load test for chatbot.py.
+
+Runs the real handlers against two local stand-ins:
+  • a fake Telegram Bot API (answers sendMessage, editMessageText, sendPhoto, ...)
+  • a fake Groq server (OpenAI-style /chat/completions, streaming or not)
+with configurable latency, token rate and error injection, replays synthetic
+updates at a given concurrency and reports p50/p95/p99 latency, messages/sec
+and event-loop lag.
+
+Example:
+    python benchmark.py --requests 500 --concurrency 50 --groq-ttft 0.3 --groq-tps 300
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from telegram import Update
+
+import chatbot
+
+FAKE_TOKEN = "123456:BENCHMARK"
+FAKE_BOT_ID = 123456
+
+FAKE_ANSWER = (
+    "*Logic:* read the input, process it, print the result.\n\n"
+    "```python\n"
+    "import sys\n\n"
+    "def main():\n"
+    "    # read every line and echo it back in upper case\n"
+    "    for line in sys.stdin:\n"
+    "        print(line.strip().upper())\n\n"
+    "if __name__ == '__main__':\n"
+    "    main()\n"
+    "```\n\n"
+    "• Run it with `python script.py < input.txt`"
+)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+# ================= 📨 FAKE TELEGRAM BOT API =================
+
+class FakeTelegram:
+    """Minimal Bot API stand-in: every method answers after `latency` seconds."""
+
+    def __init__(self, latency: float = 0.02, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._message_id = 0
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Bench"},
+        }
+        message.update(extra)
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"})
+
+        chat_id = params.get('chat_id', 1)
+        if method == 'getMe':
+            result = {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method == 'getChatMember':
+            result = {"status": "member",
+                      "user": {"id": int(params.get('user_id', 1)), "is_bot": False, "first_name": "User"}}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(chat_id, text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            photo = params.get('photo')
+            file_id = photo if isinstance(photo, str) else f"photo-{self._message_id + 1}"
+            result = self._message(chat_id, photo=[{"file_id": file_id, "file_unique_id": file_id,
+                                                    "width": 800, "height": 600}])
+        elif method == 'sendDocument':
+            result = self._message(chat_id, document={"file_id": f"doc-{self._message_id + 1}",
+                                                      "file_unique_id": f"doc-{self._message_id + 1}"})
+        elif method == 'sendMediaGroup':
+            media = json.loads(params.get('media', '[]'))
+            result = [self._message(chat_id, photo=[{"file_id": f"photo-{self._message_id + 1}",
+                                                     "file_unique_id": f"photo-{self._message_id + 1}",
+                                                     "width": 800, "height": 600}])
+                      for _ in media]
+        else:
+            # deleteMessage, sendChatAction, setWebhook, ...
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+# ================= 🧠 FAKE GROQ =================
+
+class FakeGroq:
+    """OpenAI-compatible chat completions with a time-to-first-token and a token rate."""
+
+    def __init__(self, ttft: float = 0.3, tokens_per_second: float = 250, error_rate: float = 0.0,
+                 answer: str = FAKE_ANSWER):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.tokens = answer.split(' ')
+        self.answer = answer
+        self.calls = Counter()
+
+    def _chunk(self, content=None, finish=None, usage=None):
+        chunk = {
+            "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": content} if content is not None else {},
+                         "finish_reason": finish}],
+        }
+        if usage:
+            chunk["x_groq"] = {"id": "bench", "usage": usage}
+        return f"data: {json.dumps(chunk)}\n\n".encode()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        stream = bool(body.get('stream'))
+        self.calls['stream' if stream else 'complete'] += 1
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "injected failure", "type": "server_error"}}, status=500)
+
+        usage = {"prompt_tokens": 100, "completion_tokens": len(self.tokens), "total_tokens": 100 + len(self.tokens)}
+        delay = 1 / self.tokens_per_second if self.tokens_per_second else 0
+        await asyncio.sleep(self.ttft)
+
+        if not stream:
+            await asyncio.sleep(delay * len(self.tokens))
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": body.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i, token in enumerate(self.tokens):
+            await response.write(self._chunk(token if i == 0 else ' ' + token))
+            if delay:
+                await asyncio.sleep(delay)
+        await response.write(self._chunk(finish='stop', usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+# ================= 🔁 TRAFFIC =================
+
+COMMAND_PROMPTS = {
+    'code': "/code python script number {n}",
+    'fix': "/fix print('hello' number {n}",
+    'plan': "/plan To-Do App number {n}",
+    'audit': "/audit SELECT * FROM users WHERE id = {n}",
+    'prompt': "/prompt cyberpunk city number {n}",
+    'codeimg': "/codeimg python bubble sort number {n}",
+    'chat': "how do I reverse a list, variant {n}",
+}
+
+
+def make_update(n: int, command: str, users: int, repeat_prompts: bool) -> dict:
+    user_id = 1000 + n % users
+    text = COMMAND_PROMPTS[command].format(n=0 if repeat_prompts else n)
+    message = {
+        "message_id": n + 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": n + 1, "message": message}
+
+
+def parse_mix(mix: str) -> list:
+    weighted = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in COMMAND_PROMPTS:
+            raise SystemExit(f"unknown command in --mix: {name}")
+        weighted.extend([name] * int(weight or 1))
+    return weighted
+
+
+async def measure_loop_lag(samples: list, interval: float = 0.01):
+    """Record how late a periodic sleep wakes up: a direct view of loop blocking."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def start_site(handler_routes, port: int = 0):
+    app = web.Application()
+    for method, path, handler in handler_routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+async def run(args):
+    telegram = FakeTelegram(latency=args.tg_latency, error_rate=args.tg_errors)
+    groq = FakeGroq(ttft=args.groq_ttft, tokens_per_second=args.groq_tps, error_rate=args.groq_errors)
+    tg_runner, tg_port = await start_site([('POST', '/bot{token}/{method}', telegram.handle)])
+    groq_runner, groq_port = await start_site([('POST', '/openai/v1/chat/completions', groq.handle)])
+
+    # Point the bot at the fakes and lift the production quotas
+    chatbot.llm = chatbot.LLMBackend(api_key="bench", base_url=f"http://127.0.0.1:{groq_port}")
+    chatbot.STREAM_RESPONSES = args.stream
+    chatbot.RATE_USER_PER_MIN = chatbot.RATE_CHAT_PER_MIN = 1e9
+    chatbot.RATE_USER_BURST = chatbot.RATE_CHAT_BURST = 1e9
+    chatbot.GROQ_RPM_BUDGET = chatbot.GROQ_TPM_BUDGET = 1e12
+    chatbot.admission = chatbot.AdmissionController()
+    chatbot.llm.on_usage = chatbot.admission.record_usage
+    chatbot.router.on_extra_attempt = chatbot.admission.charge
+    if not args.cache:
+        chatbot.response_cache.ttl = 0
+    chatbot.metrics.enabled = not args.no_metrics
+    chatbot.chat_settings.db_path = None  # keep the benchmark from writing a settings file
+
+    application = chatbot.build_application(FAKE_TOKEN, base_url=f"http://127.0.0.1:{tg_port}/bot")
+    await application.initialize()
+
+    mix = parse_mix(args.mix)
+    updates = [(mix[n % len(mix)], make_update(n, mix[n % len(mix)], args.users, args.repeat_prompts))
+               for n in range(args.requests)]
+    random.shuffle(updates)
+
+    latencies = defaultdict(list)
+    failures = Counter()
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+    slots = asyncio.Semaphore(args.concurrency)
+    interval = 1 / args.rate if args.rate else 0
+
+    async def one(command, data):
+        async with slots:
+            started = time.perf_counter()
+            try:
+                await application.process_update(Update.de_json(data, application.bot))
+            except Exception as e:
+                failures[type(e).__name__] += 1
+            latencies[command].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    tasks = []
+    for command, data in updates:
+        tasks.append(asyncio.create_task(one(command, data)))
+        if interval:
+            await asyncio.sleep(interval)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    lag_task.cancel()
+    await application.shutdown()
+    await chatbot.on_shutdown(application)
+    await tg_runner.cleanup()
+    await groq_runner.cleanup()
+
+    report(args, latencies, failures, elapsed, lag, telegram, groq)
+
+
+def report(args, latencies, failures, elapsed, lag, telegram, groq):
+    everything = [v for values in latencies.values() for v in values]
+    print(f"\n📊 {len(everything)} updates in {elapsed:.2f}s  →  {len(everything) / elapsed:.1f} msg/s "
+          f"(concurrency {args.concurrency}, stream={'on' if args.stream else 'off'})")
+    print(f"{'command':<10}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = sorted(latencies.items()) + [('ALL', everything)]
+    for command, values in rows:
+        print(f"{command:<10}{len(values):>6}"
+              f"{percentile(values, 50) * 1000:>8.0f}ms{percentile(values, 95) * 1000:>8.0f}ms"
+              f"{percentile(values, 99) * 1000:>8.0f}ms{max(values) * 1000:>8.0f}ms")
+    if lag:
+        print(f"\n⏱ event-loop lag: p50 {percentile(lag, 50) * 1000:.1f}ms  p99 {percentile(lag, 99) * 1000:.1f}ms  "
+              f"max {max(lag) * 1000:.1f}ms  (mean {statistics.mean(lag) * 1000:.1f}ms)")
+    print(f"📨 Bot API calls: {sum(telegram.calls.values())} "
+          f"({sum(telegram.calls.values()) / max(1, len(everything)):.1f}/update) {dict(telegram.calls)}")
+    print(f"🧠 Groq calls: {dict(groq.calls)}")
+    if failures:
+        print(f"❌ failures: {dict(failures)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline load test for chatbot.py")
+    parser.add_argument('--requests', type=int, default=200, help='total updates to replay')
+    parser.add_argument('--concurrency', type=int, default=20, help='updates in flight at once')
+    parser.add_argument('--rate', type=float, default=0, help='updates per second to inject (0 = as fast as possible)')
+    parser.add_argument('--users', type=int, default=50, help='distinct users/chats the updates come from')
+    parser.add_argument('--mix', default='code=2,chat=3,fix=1,plan=1,codeimg=1',
+                        help='command weights, e.g. code=2,chat=3')
+    parser.add_argument('--repeat-prompts', action='store_true', help='send identical prompts (exercises caches)')
+    parser.add_argument('--cache', action='store_true', help='keep the response cache enabled')
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=chatbot.STREAM_RESPONSES,
+                        help='stream answers into the status message')
+    parser.add_argument('--no-metrics', action='store_true', help='disable chatbot instrumentation')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='seconds per fake Bot API call')
+    parser.add_argument('--tg-errors', type=float, default=0.0, help='fraction of Bot API calls that fail')
+    parser.add_argument('--groq-ttft', type=float, default=0.3, help='fake Groq time to first token (s)')
+    parser.add_argument('--groq-tps', type=float, default=250, help='fake Groq tokens per second')
+    parser.add_argument('--groq-errors', type=float, default=0.0, help='fraction of Groq calls that fail')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    asyncio.run(run(args))
@@ -1,28 +1,52 @@
+import time
+STARTUP_STARTED = time.perf_counter()  # taken first, so the startup report covers every import below
+
 import logging
 import asyncio
+import argparse
+import contextlib
+import contextvars
+import functools
+import hashlib
+import hmac
+import html
+import importlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import threading
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode, ChatAction
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
-from telegram.error import BadRequest
-from groq import Groq
-
-# Optional nice console output for the operator (uses `rich` if installed)
-try:
-    from rich.console import Console
-    console = Console()
-except Exception:
-    console = None
-
-# Optional: generate syntax-highlighted code images using Pygments
-try:
-    from pygments import highlight
-    from pygments.lexers import guess_lexer, get_lexer_by_name
-    from pygments.formatters import ImageFormatter
-    PYGMENTS_AVAILABLE = True
-except Exception:
-    PYGMENTS_AVAILABLE = False
+from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, ChatMemberHandler, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
+import httpx
+# groq, aiohttp, rich, Pygments and PIL are imported where they are first
+# used (or by the background warm-up), which keeps restarts quick
+
+
+def get_console():
+    """Optional nice console output for the operator (uses `rich` if installed)."""
+    try:
+        from rich.console import Console
+    except Exception:
+        return None
+    return Console()
+
+
+# Optional: generate syntax-highlighted code images using Pygments (+ Pillow)
+PYGMENTS_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ('pygments', 'PIL'))
 
 # ================= 🔧 CONFIGURATION =================
 
@@ -39,10 +63,335 @@ BOT_NAME = "Codeninja AI"
 OWNER_INSTAGRAM = "codeninjavik"
 OWNER_YOUTUBE = "codeninjavik"
 
+# ⚙️ 4. PERFORMANCE
+LLM_MAX_CONCURRENCY = 32      # max Groq completions in flight at once
+LLM_MAX_CONNECTIONS = 64      # size of the shared HTTP connection pool
+LLM_REQUEST_TIMEOUT = 60.0    # seconds before a single completion is cancelled
+UPDATE_CONCURRENCY = 256      # max Telegram updates handled concurrently
+STREAM_RESPONSES = True       # edit the status message as tokens arrive
+STREAM_EDIT_INTERVAL = 1.2    # min seconds between two edits of the same message
+STREAM_MIN_NEW_CHARS = 40     # don't bother editing for fewer new characters
+RENDER_WORKERS = 2            # processes (or threads) rendering code images
+RENDER_USE_PROCESSES = True   # False -> render in a thread pool instead
+RENDER_MAX_PENDING = 8        # renders queued+running before we fall back to text
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024  # in-memory PNG cache budget
+RENDER_CACHE_MAX_FILE_IDS = 50_000         # remembered Telegram photo file_ids
+RENDER_CACHE_DIR = None       # e.g. "render_cache" to keep PNGs on disk across restarts
+RENDER_IMAGE_FORMAT = 'PNG'   # 'PNG' (palette + optimize) or 'WEBP' (lossless)
+RENDER_PALETTE_COLORS = 64    # code screenshots only have a handful of colours
+RENDER_MAX_TILE_HEIGHT = 2000 # px; taller renders are cut at line boundaries into several images
+RENDER_MAX_IMAGES = 20        # images per answer; code blocks beyond this are sent as text
+WARMUP_ENABLED = True         # once the bot is up, preload the Groq client, fonts and lexers in the background
+WARMUP_LEXERS = ('python', 'javascript', 'bash', 'php', 'html', 'json', 'sql')
+SUBSCRIPTION_TTL = 600        # seconds a confirmed channel member is trusted
+SUBSCRIPTION_NEGATIVE_TTL = 30  # seconds a non-member is remembered (short, so joining works fast)
+SUBSCRIPTION_CACHE_MAX = 100_000
+RESPONSE_CACHE_TTL = 6 * 3600   # seconds an AI answer may be reused
+RESPONSE_CACHE_MAX = 5_000      # answers kept in memory
+RESPONSE_CACHE_DB = None        # e.g. "response_cache.sqlite3" to survive restarts
+CHAT_HISTORY_TOKEN_BUDGET = 1500  # max (estimated) history tokens sent with each /chat message
+CHAT_HISTORY_MAX_CHATS = 10_000   # idle chats beyond this are evicted (LRU)
+CHAT_HISTORY_DB = None            # e.g. "chat_history.sqlite3" to keep conversations on disk
+SETTINGS_DB = "chat_settings.sqlite3"  # per-chat /theme, /mode, /model choices (None = memory only)
+SETTINGS_FLUSH_INTERVAL = 2.0     # seconds between batched settings writes
+SETTINGS_REFRESH_INTERVAL = 30.0  # seconds between picking up settings changed by other bot processes
+RATE_USER_PER_MIN = 6         # AI requests a single user may make per minute...
+RATE_USER_BURST = 3           # ...with at most this many back to back
+RATE_CHAT_PER_MIN = 20        # same for a whole (group) chat
+RATE_CHAT_BURST = 8
+GROQ_RPM_BUDGET = 30          # Groq requests per minute for the whole bot
+GROQ_TPM_BUDGET = 12_000      # Groq tokens per minute for the whole bot
+ADMISSION_QUEUE_MAX = 100     # requests waiting for global budget before we refuse new ones
+ADMISSION_MAX_WAIT = 20.0     # seconds a queued request waits before it is refused
+METRICS_ENABLED = True        # False -> instrumentation is a no-op and no endpoint is started
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9100           # Prometheus text format at http://METRICS_LISTEN:METRICS_PORT/metrics
+
+# 🌐 5. WEBHOOK MODE (python chatbot.py --webhook)
+WEBHOOK_URL = None            # public base URL Telegram posts to, e.g. "https://bot.example.com" (None = don't register)
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = None         # compared with the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_QUEUE_SIZE = 1000     # updates accepted but not yet processed; beyond this we answer 503
+WEBHOOK_WORKERS = 64          # updates processed concurrently
+WEBHOOK_DRAIN_TIMEOUT = 30.0  # seconds to finish queued updates on shutdown
+
+# 🧩 6. SHARDING (python chatbot.py --workers N)
+SHARD_WORKERS = 0             # bot processes, each owning the chats with chat_id % N == i (0 = single process)
+SHARD_QUEUE_SIZE = 1000       # updates waiting for one worker before the ingress blocks
+SHARD_MAX_PENDING = 512       # updates a worker has accepted but not finished
+SHARD_RESTART_DELAY = 1.0     # seconds before a crashed worker is started again
+SHARD_METRICS_INTERVAL = 5.0  # seconds between metrics snapshots sent to the supervisor
+POLL_TIMEOUT = 30             # getUpdates long-poll timeout used by the sharded ingress
+
 # ================= 🧠 AI BRAIN SETUP =================
-client = Groq(api_key=GROQ_API_KEY)
 # Using the stable, fast Llama 3 model
 GROQ_MODEL = "llama-3.3-70b-versatile"
+GROQ_TEMPERATURE = 0.7
+# Small model for short, simple prompts (and as the fallback when the big one fails)
+FAST_MODEL = "llama-3.1-8b-instant"
+FAST_PROMPT_CHARS = 300            # prompts shorter than this (without code) may use FAST_MODEL
+SMART_COMMANDS = {'fix', 'audit'}  # always use GROQ_MODEL
+COMMAND_MAX_TOKENS = {'code': 2048, 'fix': 2048, 'audit': 2048, 'plan': 1500,
+                      'codeimg': 1024, 'chat': 1024, 'prompt': 600}
+HEDGE_AFTER = 2.0                  # seconds without a first token before an identical request is raced (0 = never)
+LLM_RETRIES = 2                    # extra attempts (on the fallback model) after a failure
+LLM_RETRY_BASE_DELAY = 0.5         # seconds; backoff is jittered and doubles per attempt
+
+
+class LLMBackend:
+    """Async Groq client shared by every handler.
+
+    One pooled HTTP connection is reused for all completions, at most
+    `max_concurrency` requests are in flight, and each request is cancelled
+    after `timeout` seconds so a stuck upstream never pins a handler.
+    """
+
+    def __init__(self, api_key: str, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 max_connections: int = LLM_MAX_CONNECTIONS, timeout: float = LLM_REQUEST_TIMEOUT,
+                 base_url: str = None):
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.base_url = base_url
+        self._client = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.on_usage = None  # optional callback(completion_tokens) for budget tracking
+
+    def _report_usage(self, usage):
+        if usage is not None and self.on_usage is not None:
+            self.on_usage(usage.completion_tokens or 0)
+
+    @property
+    def client(self):
+        # Built lazily so the pool is created inside the running event loop
+        if self._client is None:
+            from groq import AsyncGroq, DefaultAsyncHttpxClient
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+            )
+            self._client = AsyncGroq(api_key=self.api_key, base_url=self.base_url,
+                                     http_client=http_client, max_retries=1)
+        return self._client
+
+    async def complete(self, messages, model: str = GROQ_MODEL, temperature: float = GROQ_TEMPERATURE,
+                       max_tokens: int = 2048, timeout: float = None) -> str:
+        """Run one chat completion and return the reply text.
+
+        Raises asyncio.TimeoutError if the request takes longer than `timeout`.
+        Cancelling the calling task aborts the HTTP request as well.
+        """
+        async with self._slots:
+            chat_completion = await asyncio.wait_for(
+                self.client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                ),
+                timeout=timeout or self.timeout,
+            )
+        self._report_usage(chat_completion.usage)
+        return chat_completion.choices[0].message.content
+
+    async def stream(self, messages, model: str = GROQ_MODEL, temperature: float = GROQ_TEMPERATURE,
+                     max_tokens: int = 2048, timeout: float = None):
+        """Async generator yielding reply text chunks as Groq streams them.
+
+        `timeout` applies to the wait for each chunk, so long answers are fine
+        as long as tokens keep arriving.
+        """
+        timeout = timeout or self.timeout
+        async with self._slots:
+            stream = await asyncio.wait_for(
+                self.client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                ),
+                timeout=timeout,
+            )
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        break
+                    # Groq reports usage on the last chunk under `x_groq`
+                    self._report_usage(getattr(getattr(chunk, 'x_groq', None), 'usage', None))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+
+    async def aclose(self):
+        """Close the pooled HTTP connection (called on bot shutdown)."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+llm = LLMBackend(api_key=GROQ_API_KEY)
+
+
+class Route:
+    """Which model to ask, what to fall back to, and how many tokens to allow."""
+    __slots__ = ('model', 'fallback', 'max_tokens')
+
+    def __init__(self, model: str, fallback: str, max_tokens: int):
+        self.model = model
+        self.fallback = fallback
+        self.max_tokens = max_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def non_retryable_errors() -> tuple:
+    """Errors where asking again (or asking another model) can't help."""
+    from groq import AuthenticationError, BadRequestError, PermissionDeniedError
+    return BadRequestError, AuthenticationError, PermissionDeniedError
+
+
+class ModelRouter:
+    """Chooses a model per request and adds hedging + failover around `llm`.
+
+    Short prompts without code go to FAST_MODEL; /fix, /audit and anything
+    long or containing code go to GROQ_MODEL, unless the chat picked a model
+    with /model (`preference` 'fast' or 'smart'). A completion or stream that
+    has not produced its first token after HEDGE_AFTER seconds is raced
+    against a duplicate request, and failures are retried on the other model with
+    jittered exponential backoff. Hedges and retries are extra Groq calls,
+    reported through `on_extra_attempt(prompt_tokens)` so admission control
+    can charge them.
+    """
+
+    def __init__(self):
+        self.on_extra_attempt = None
+
+    def _charge_extra(self, messages):
+        if self.on_extra_attempt is not None:
+            self.on_extra_attempt(estimate_prompt_tokens(messages))
+
+    def route(self, command: str, prompt_text: str, preference: str = 'auto') -> Route:
+        max_tokens = COMMAND_MAX_TOKENS.get(command, 2048)
+        if preference == 'fast':
+            return Route(FAST_MODEL, GROQ_MODEL, max_tokens)
+        if preference == 'smart':
+            return Route(GROQ_MODEL, FAST_MODEL, max_tokens)
+        simple = len(prompt_text) < FAST_PROMPT_CHARS and '```' not in prompt_text
+        if command in SMART_COMMANDS or not simple:
+            return Route(GROQ_MODEL, FAST_MODEL, max_tokens)
+        return Route(FAST_MODEL, GROQ_MODEL, max_tokens)
+
+    def _attempts(self, route: Route):
+        return [route.model] + [route.fallback] * LLM_RETRIES
+
+    @staticmethod
+    async def _backoff(attempt: int):
+        await asyncio.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def complete(self, messages, route: Route, temperature: float = GROQ_TEMPERATURE) -> str:
+        attempts = self._attempts(route)
+        for attempt, model in enumerate(attempts):
+            if attempt:
+                self._charge_extra(messages)
+            try:
+                return await self._hedged(messages, model, route.max_tokens, temperature)
+            except non_retryable_errors():
+                raise
+            except Exception as e:
+                if attempt == len(attempts) - 1:
+                    raise
+                logging.warning(f"{model} failed ({type(e).__name__}: {e}), retrying on {attempts[attempt + 1]}")
+                metrics.inc('bot_llm_retries_total', (('model', model),))
+                await self._backoff(attempt)
+
+    async def _hedged(self, messages, model: str, max_tokens: int, temperature: float) -> str:
+        if not HEDGE_AFTER:
+            return await llm.complete(messages, model=model, temperature=temperature, max_tokens=max_tokens)
+        return "".join([piece async for piece in self._hedged_stream(messages, model, max_tokens, temperature)])
+
+    async def _hedged_stream(self, messages, model: str, max_tokens: int, temperature: float):
+        """Stream `messages`, racing a duplicate request if no token arrives within HEDGE_AFTER.
+
+        The hedge is judged on time-to-first-token, which doesn't grow with
+        the length of the answer. The first attempt to yield a token (or to
+        finish) wins and is streamed on; the other is cancelled.
+        """
+        def start():
+            stream = llm.stream(messages, model=model, temperature=temperature, max_tokens=max_tokens)
+            return stream, asyncio.ensure_future(stream.__anext__())
+
+        def answered(first) -> bool:
+            error = first.exception()
+            return error is None or isinstance(error, StopAsyncIteration)
+
+        attempts = [start()]
+        try:
+            if HEDGE_AFTER:
+                done, _ = await asyncio.wait({attempts[0][1]}, timeout=HEDGE_AFTER)
+                if not done:
+                    metrics.inc('bot_llm_hedges_total', (('model', model),))
+                    self._charge_extra(messages)
+                    attempts.append(start())
+            # Wait until an attempt starts answering, or every attempt has failed
+            pending = {first for _, first in attempts}
+            winner = None
+            while winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                ended = [attempt for attempt in attempts if attempt[1] in done]
+                winner = next((attempt for attempt in ended if answered(attempt[1])), None)
+                if winner is None and not pending:
+                    winner = ended[0]  # its error is raised below
+            if winner is not attempts[0]:
+                metrics.inc('bot_llm_hedge_wins_total', (('model', model),))
+            stream, first = winner
+            try:
+                piece = first.result()
+            except StopAsyncIteration:
+                return
+            yield piece
+            async for piece in stream:
+                yield piece
+        finally:
+            # Also runs when our caller is cancelled or stops reading: no attempt outlives it
+            for stream, first in attempts:
+                if not first.done():
+                    first.cancel()
+                elif not first.cancelled():
+                    first.exception()  # a losing attempt's error is expected
+                    await stream.aclose()
+
+    async def stream(self, messages, route: Route, temperature: float = GROQ_TEMPERATURE):
+        """Stream with failover. Once text has been yielded a failure can't be
+        retried (the user already saw it), so it is raised instead.
+        """
+        attempts = self._attempts(route)
+        for attempt, model in enumerate(attempts):
+            if attempt:
+                self._charge_extra(messages)
+            started = False
+            try:
+                async for piece in self._hedged_stream(messages, model, route.max_tokens, temperature):
+                    started = True
+                    yield piece
+                return
+            except non_retryable_errors():
+                raise
+            except Exception as e:
+                if started or attempt == len(attempts) - 1:
+                    raise
+                logging.warning(f"{model} stream failed ({type(e).__name__}: {e}), retrying on {attempts[attempt + 1]}")
+                metrics.inc('bot_llm_retries_total', (('model', model),))
+                await self._backoff(attempt)
+
+
+router = ModelRouter()
 
 # 🔥 SYSTEM PROMPT (Controls Bot Personality & Format)
 SYSTEM_PROMPT = """
@@ -66,6 +415,276 @@ logging.basicConfig(
     level=logging.INFO
 )
 
+# ================= 📊 METRICS =================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (8_000, 16_000, 32_000, 64_000, 128_000, 256_000, 512_000, 1_000_000, 2_000_000, 5_000_000)
+
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP_STAGE = _NoopStage()
+
+
+class Span:
+    """Timings of one handled update: the whole request plus named stages."""
+    __slots__ = ('metrics', 'command', 'started', 'stages')
+
+    def __init__(self, metrics, command: str):
+        self.metrics = metrics
+        self.command = command
+        self.started = time.perf_counter()
+        self.stages = []
+
+    def stage(self, name: str):
+        return _SpanStage(self, name)
+
+    def finish(self, outcome: str):
+        total = time.perf_counter() - self.started
+        self.metrics.observe('bot_request_seconds', total, (('command', self.command), ('outcome', outcome)))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            breakdown = " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.stages)
+            logging.debug(f"/{self.command} {total * 1000:.0f}ms {breakdown}")
+
+
+class _SpanStage:
+    __slots__ = ('span', 'name', 'started')
+
+    def __init__(self, span: Span, name: str):
+        self.span = span
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        self.span.stages.append((self.name, seconds))
+        self.span.metrics.observe('bot_stage_seconds', seconds, (('command', self.span.command), ('stage', self.name)))
+        return False
+
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Metrics:
+    """Tiny in-process metrics registry rendered in the Prometheus text format.
+
+    Counters, gauges and fixed-bucket histograms are keyed on (name, labels),
+    with labels a tuple of (key, value) pairs. `collectors` are callables
+    returning extra (name, type, labels, value) samples at scrape time, which
+    is how the caches and pools export their own counters. When disabled every
+    call returns straight away.
+    """
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # (name, labels) -> (buckets, [bucket counts..., sum, count])
+        self.collectors = []
+        self.remote = {}      # source -> snapshot() of another process, merged into render()
+        self._server = None
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        if self.enabled:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name: str, delta: float, labels: tuple = ()):
+        if self.enabled:
+            key = (name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        entry = self.histograms.get(key)
+        if entry is None:
+            entry = self.histograms[key] = (buckets, [0] * (len(buckets) + 2))
+        buckets, hist = entry
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+    def instrument(self, command: str, handler):
+        """Wrap a handler so each call gets a Span and an in-flight gauge."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if not self.enabled:
+                return await handler(update, context)
+            span = Span(self, command)
+            token = _current_span.set(span)
+            labels = (('command', command),)
+            self.gauge_add('bot_requests_in_flight', 1, labels)
+            outcome = 'ok'
+            try:
+                return await handler(update, context)
+            except BaseException:
+                outcome = 'error'
+                raise
+            finally:
+                self.gauge_add('bot_requests_in_flight', -1, labels)
+                span.finish(outcome)
+                _current_span.reset(token)
+        return wrapper
+
+    # ---- exposition ----
+
+    @staticmethod
+    def _labels(labels, extra: str = '') -> str:
+        parts = [f'{k}="{str(v)}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def snapshot(self) -> dict:
+        """Picklable copy of everything this registry would render (collectors included)."""
+        collected = []
+        for collect in self.collectors:
+            try:
+                collected.extend(collect())
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {key: (buckets, list(hist)) for key, (buckets, hist) in self.histograms.items()},
+            'collected': collected,
+        }
+
+    def _merged(self):
+        """Local series plus every remote snapshot: counters and histograms are
+        summed, gauges keep one series per source (`shard` label).
+        """
+        counters = dict(self.counters)
+        gauges = dict(self.gauges)
+        histograms = {key: (buckets, list(hist)) for key, (buckets, hist) in self.histograms.items()}
+        for source, snap in sorted(self.remote.items()):
+            for key, value in snap['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+            for (name, labels), value in snap['gauges'].items():
+                gauges[(name, labels + (('shard', source),))] = value
+            for key, (buckets, hist) in snap['histograms'].items():
+                mine = histograms.get(key)
+                if mine is None:
+                    histograms[key] = (buckets, list(hist))
+                elif mine[0] == buckets:
+                    mine[1][:] = [a + b for a, b in zip(mine[1], hist)]
+            for name, kind, labels, value in snap['collected']:
+                if kind == 'counter':
+                    counters[(name, labels)] = counters.get((name, labels), 0) + value
+                else:
+                    gauges[(name, labels + (('shard', source),))] = value
+        return counters, gauges, histograms
+
+    def render(self) -> str:
+        samples = {}  # name -> (type, [lines])
+
+        def add(name, kind, line):
+            samples.setdefault(name, (kind, []))[1].append(line)
+
+        counters, gauges, histograms = self._merged() if self.remote else (self.counters, self.gauges, self.histograms)
+        for (name, labels), value in counters.items():
+            add(name, 'counter', f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in gauges.items():
+            add(name, 'gauge', f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, hist) in histograms.items():
+            cumulative = 0
+            for bound, count in zip(buckets, hist):
+                cumulative += count
+                le = self._labels(labels, f'le="{bound}"')
+                add(name, 'histogram', f"{name}_bucket{le} {cumulative}")
+            le = self._labels(labels, 'le="+Inf"')
+            add(name, 'histogram', f"{name}_bucket{le} {hist[-1]}")
+            add(name, 'histogram', f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            add(name, 'histogram', f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for collect in self.collectors:
+            try:
+                for name, kind, labels, value in collect():
+                    add(name, kind, f"{name}{self._labels(labels)} {value}")
+            except Exception as e:
+                logging.warning(f"Metrics collector failed: {e}")
+
+        out = []
+        for name, (kind, lines) in sorted(samples.items()):
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    async def start_server(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        if not self.enabled or self._server is not None:
+            return
+        # aiohttp takes a while to import; do it off the event loop
+        web = await asyncio.to_thread(importlib.import_module, 'aiohttp.web')
+
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        self._server = web.AppRunner(app, access_log=None)
+        await self._server.setup()
+        await web.TCPSite(self._server, listen, port).start()
+        logging.info(f"Metrics on http://{listen}:{port}/metrics")
+
+    async def stop_server(self):
+        if self._server is not None:
+            await self._server.cleanup()
+            self._server = None
+
+
+metrics = Metrics()
+
+
+class StartupTimer:
+    """How long each startup phase took; logged once and exported as bot_startup_seconds."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.phases = {}
+
+    def mark(self, phase: str):
+        """End `phase` now; it lasted since the previous mark."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = seconds
+
+    def report(self) -> str:
+        return "Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+
+    def collect(self):
+        for phase, seconds in self.phases.items():
+            yield 'bot_startup_seconds', 'gauge', (('phase', phase),), round(seconds, 4)
+
+
+startup = StartupTimer(STARTUP_STARTED)
+metrics.collectors.append(startup.collect)
+
+
+def stage(name: str):
+    """Context manager timing `name` within the current request span (no-op outside one)."""
+    span = _current_span.get()
+    return span.stage(name) if span is not None else NOOP_STAGE
+
+
 # ================= 🛠 HELPER FUNCTIONS =================
 
 def get_watermark():
@@ -80,86 +699,1222 @@ def get_watermark():
 
 def get_watermark_markdown():
     """Return a Markdown version of the watermark (used when sending Markdown)."""
+    # Handles like @Codeninja_vik contain underscores, which Markdown would read as italics
+    esc = functools.partial(escape_markdown, version=1)
     return (
         f"\n\n──────────────────────\n"
-        f"🤖 *{BOT_NAME}* • {REQUIRED_CHANNEL}\n"
-        f"👨‍💻 Dev: {OWNER_CONTACT}\n"
-        f"📸 Instagram: @{OWNER_INSTAGRAM} • ▶️ YouTube: @{OWNER_YOUTUBE}"
+        f"🤖 *{esc(BOT_NAME)}* • {esc(REQUIRED_CHANNEL)}\n"
+        f"👨‍💻 Dev: {esc(OWNER_CONTACT)}\n"
+        f"📸 Instagram: @{esc(OWNER_INSTAGRAM)} • ▶️ YouTube: @{esc(OWNER_YOUTUBE)}"
     )
 
+class SubscriptionCache:
+    """Per-user cache of REQUIRED_CHANNEL membership.
+
+    Members are trusted for SUBSCRIPTION_TTL seconds and non-members for
+    SUBSCRIPTION_NEGATIVE_TTL. Concurrent lookups for the same user share one
+    get_chat_member call, and chat_member updates from the channel overwrite
+    the cached value so it stays correct without polling.
+    """
+
+    def __init__(self, ttl: float = SUBSCRIPTION_TTL, negative_ttl: float = SUBSCRIPTION_NEGATIVE_TTL,
+                 max_entries: int = SUBSCRIPTION_CACHE_MAX):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}   # user_id -> (is_member, expires_at)
+        self._inflight = {}  # user_id -> Task running get_chat_member
+        self.hits = 0
+        self.misses = 0
+
+    def set(self, user_id: int, is_member: bool):
+        loop_time = asyncio.get_running_loop().time()
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (is_member, loop_time + (self.ttl if is_member else self.negative_ttl))
+        if len(self._entries) > self.max_entries:
+            self._prune(loop_time)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def _prune(self, now: float):
+        for user_id in [u for u, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[user_id]
+        # Still full: drop the oldest entries (dicts keep insertion order)
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+    async def is_member(self, bot, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > asyncio.get_running_loop().time():
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        # shield: one impatient caller being cancelled must not cancel the others
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, user_id: int) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
+        except Exception as e:
+            # If bot isn't admin or error occurs, allow access (Fail-Safe) but don't cache it
+            logging.error(f"⚠️ Channel Check Error: {e}")
+            return True
+        is_member = member.status not in ['left', 'kicked']
+        self.set(user_id, is_member)
+        return is_member
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+subscription_cache = SubscriptionCache()
+
+
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Checks if the user is a member of the required channel."""
-    user_id = update.effective_user.id
-    try:
-        member = await context.bot.get_chat_member(chat_id=REQUIRED_CHANNEL, user_id=user_id)
-        if member.status in ['left', 'kicked']:
-            return False
+    """Checks if the user is a member of the required channel (cached)."""
+    with stage('subscription'):
+        return await subscription_cache.is_member(context.bot, update.effective_user.id)
+
+
+def is_required_channel(chat_id, username: str = None) -> bool:
+    """True if the chat is REQUIRED_CHANNEL (given as @username or numeric id)."""
+    if str(chat_id) == REQUIRED_CHANNEL:
         return True
+    return bool(username) and f"@{username}".lower() == REQUIRED_CHANNEL.lower()
+
+
+async def handle_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keeps the subscription cache in sync with joins/leaves on the channel."""
+    change = update.chat_member
+    if not change or not is_required_channel(change.chat.id, change.chat.username):
+        return
+    subscription_cache.set(change.new_chat_member.user.id, change.new_chat_member.status not in ['left', 'kicked'])
+
+class SQLiteExecutor:
+    """A SQLite connection used only from one dedicated thread.
+
+    `call(fn, *args)` runs `fn` on that thread and returns an awaitable; `fn`
+    gets the connection from `connect(path)`, which opens it on first use and
+    runs the `schema` statements once.
+    """
+
+    def __init__(self, thread_name: str, schema=()):
+        self.thread_name = thread_name
+        self.schema = schema
+        self._db = None
+        self._executor = None
+
+    def connect(self, path: str) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            for statement in self.schema:
+                self._db.execute(statement)
+        return self._db
+
+    def call(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.thread_name)
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        if self._executor is not None:
+            if self._db is not None:
+                self._executor.submit(self._db.close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._db = None
+
+
+# Prompts for these commands usually contain code, where case matters
+CASE_SENSITIVE_COMMANDS = {'fix', 'audit'}
+
+
+class ResponseCache:
+    """Cache of AI answers keyed on (command, normalized prompt, model, temperature).
+
+    Entries expire after `ttl` seconds and the in-memory LRU holds at most
+    `max_entries`. With `db_path` set, answers are also written to SQLite so
+    they survive restarts. Identical requests that arrive while the first one
+    is still waiting on Groq share its result instead of calling Groq again.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX,
+                 db_path: str = RESPONSE_CACHE_DB):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries = OrderedDict()  # key -> (text, expires_at)
+        self._inflight = {}            # key -> Task or Future of the answer being generated
+        self._sql = SQLiteExecutor('response-cache', (
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT, expires_at REAL)",
+        ))
+        self.hits = Counter()          # command -> hits
+        self.misses = Counter()        # command -> misses
+
+    @staticmethod
+    def key(command: str, prompt_text: str, model: str, temperature: float) -> str:
+        normalized = " ".join(prompt_text.split())
+        if command not in CASE_SENSITIVE_COMMANDS:
+            normalized = normalized.casefold()
+        raw = f"{command}\0{model}\0{temperature}\0{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    # ---- SQLite tier (all calls run on one dedicated thread) ----
+
+    def _db_get(self, key: str):
+        row = self._sql.connect(self.db_path).execute(
+            "SELECT text, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row
+
+    def _db_put(self, key: str, text: str, expires_at: float):
+        db = self._sql.connect(self.db_path)
+        db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, expires_at))
+        db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        db.commit()
+
+    # ---- public API ----
+
+    async def _read(self, key: str):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            self._entries.move_to_end(key)
+            return entry[0]
+        if entry:
+            del self._entries[key]
+        if self.db_path:
+            try:
+                row = await self._sql.call(self._db_get, key)
+            except sqlite3.Error as e:
+                logging.warning(f"Response cache read failed: {e}")
+                row = None
+            if row:
+                self._remember(key, row[0], row[1])
+                return row[0]
+        return None
+
+    async def get(self, command: str, prompt_text: str, model: str, temperature: float):
+        """Return a cached answer or None (counts a hit/miss for `command`)."""
+        text = await self._read(self.key(command, prompt_text, model, temperature))
+        if text is None:
+            self.misses[command] += 1
+        else:
+            self.hits[command] += 1
+        return text
+
+    async def _lookup(self, command: str, key: str):
+        """(cached text, None), (None, in-flight future to wait on) or (None, None).
+
+        Only the last case counts as a miss, and it returns without awaiting
+        after the final in-flight check, so the caller can register itself as
+        the request in flight before anyone else looks.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            text = await self._read(key)
+            if text is not None:
+                self.hits[command] += 1
+                return text, None
+            inflight = self._inflight.get(key)  # another caller may have started while we read the DB
+        if inflight is not None:
+            self.hits[command] += 1
+            return None, inflight
+        self.misses[command] += 1
+        return None, None
+
+    def _remember(self, key: str, text: str, expires_at: float):
+        self._entries[key] = (text, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def put(self, command: str, prompt_text: str, model: str, temperature: float, text: str, _key: str = None):
+        key = _key or self.key(command, prompt_text, model, temperature)
+        expires_at = time.time() + self.ttl
+        self._remember(key, text, expires_at)
+        if self.db_path:
+            try:
+                await self._sql.call(self._db_put, key, text, expires_at)
+            except sqlite3.Error as e:
+                logging.warning(f"Response cache write failed: {e}")
+
+    async def get_or_compute(self, command: str, prompt_text: str, model: str, temperature: float, compute):
+        """Return the cached answer, or await `compute()` once for all identical callers.
+        Exceptions from `compute` are propagated and never cached.
+        """
+        key = self.key(command, prompt_text, model, temperature)
+        cached, task = await self._lookup(command, key)
+        if cached is not None:
+            return cached
+        if task is None:
+            async def run():
+                text = await compute()
+                await self.put(command, prompt_text, model, temperature, text, _key=key)
+                return text
+            task = asyncio.ensure_future(run())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._inflight.pop(key) if self._inflight.get(key) is done else None)
+        return await asyncio.shield(task)
+
+    async def begin(self, command: str, prompt_text: str, model: str, temperature: float):
+        """Streaming counterpart of get_or_compute.
+
+        Returns (text, None) when the answer is cached or an identical request
+        is already being generated (its result is awaited and returned whole).
+        Otherwise returns (None, finish): the caller generates the answer itself
+        and must `await finish(text)` with the full answer, or
+        `await finish(error=exc)` if it failed, to release waiting callers.
+        """
+        key = self.key(command, prompt_text, model, temperature)
+        cached, inflight = await self._lookup(command, key)
+        if cached is not None:
+            return cached, None
+        if inflight is not None:
+            return await asyncio.shield(inflight), None
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+
+        async def finish(text: str = None, error: BaseException = None):
+            if future.done():
+                return
+            if text is not None:
+                future.set_result(text)
+                self._inflight.pop(key, None)
+                await self.put(command, prompt_text, model, temperature, text, _key=key)
+            else:
+                future.set_exception(error or RuntimeError('the identical request in progress was interrupted'))
+                future.exception()  # nobody may be waiting; don't warn about it
+                self._inflight.pop(key, None)
+        return None, finish
+
+    def hit_rate(self, command: str) -> float:
+        total = self.hits[command] + self.misses[command]
+        return self.hits[command] / total if total else 0.0
+
+    def stats(self) -> dict:
+        commands = set(self.hits) | set(self.misses)
+        return {cmd: {'hits': self.hits[cmd], 'misses': self.misses[cmd], 'hit_rate': self.hit_rate(cmd)}
+                for cmd in sorted(commands)}
+
+    def close(self):
+        self._sql.close()
+
+
+response_cache = ResponseCache()
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token for Llama tokenizers) plus per-message overhead."""
+    return len(text) // 4 + 4
+
+
+def estimate_prompt_tokens(messages) -> int:
+    """Token estimate of a whole chat-completion prompt (system prompt, history and question)."""
+    return sum(estimate_tokens(m['content']) for m in messages)
+
+
+class Conversation:
+    """History of one chat: a deque of (is_user, text, tokens) turns plus a running token total.
+    Turns that no longer fit the budget are folded into a one-line `summary`.
+    """
+    __slots__ = ('turns', 'tokens', 'summary')
+
+    def __init__(self, turns=(), summary: str = ''):
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = summary
+        for is_user, text in turns:
+            self.append(is_user, text)
+
+    def append(self, is_user: bool, text: str):
+        tokens = estimate_tokens(text)
+        self.turns.append((is_user, text, tokens))
+        self.tokens += tokens
+
+    def trim(self, budget: int):
+        """Drop the oldest turns until history (summary included) fits `budget` tokens."""
+        dropped = []
+        while self.turns and self.tokens + estimate_tokens(self.summary) > budget:
+            is_user, text, tokens = self.turns.popleft()
+            self.tokens -= tokens
+            if is_user:
+                dropped.append(" ".join(text.split())[:80])
+        if dropped:
+            # Keep the gist of what the user asked about, within a quarter of the budget
+            topics = [t for t in self.summary.split(' | ') if t] + dropped
+            while topics and estimate_tokens(' | '.join(topics)) > budget // 4:
+                topics.pop(0)
+            self.summary = ' | '.join(topics)
+
+    def to_messages(self) -> list:
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Earlier in this chat the user asked about: {self.summary}"})
+        for is_user, text, _ in self.turns:
+            messages.append({"role": "user" if is_user else "assistant", "content": text})
+        return messages
+
+    def to_json(self) -> str:
+        return json.dumps({'summary': self.summary, 'turns': [[u, t] for u, t, _ in self.turns]})
+
+    @classmethod
+    def from_json(cls, raw: str):
+        data = json.loads(raw)
+        return cls(turns=data.get('turns', ()), summary=data.get('summary', ''))
+
+
+class ConversationStore:
+    """Per-chat conversation memory for /chat.
+
+    Each chat keeps at most `token_budget` estimated tokens of history (oldest
+    turns are trimmed into a short summary), and only `max_chats` chats stay in
+    memory, least recently active evicted first. With `db_path` set, histories
+    are written to SQLite and reloaded when an evicted chat comes back.
+    Hold `lock(chat_id)` across a whole turn so concurrent messages of one chat
+    each see the previous exchange.
+    """
+
+    def __init__(self, token_budget: int = CHAT_HISTORY_TOKEN_BUDGET, max_chats: int = CHAT_HISTORY_MAX_CHATS,
+                 db_path: str = CHAT_HISTORY_DB):
+        self.token_budget = token_budget
+        self.max_chats = max_chats
+        self.db_path = db_path
+        self._chats = OrderedDict()  # chat_id -> Conversation
+        self._locks = {}             # chat_id -> [asyncio.Lock, holders + waiters]
+        self._sql = SQLiteExecutor('chat-history', (
+            "CREATE TABLE IF NOT EXISTS conversations (chat_id TEXT PRIMARY KEY, data TEXT)",
+        ))
+
+    def _db_load(self, chat_id: str):
+        row = self._sql.connect(self.db_path).execute("SELECT data FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def _db_save(self, chat_id: str, data):
+        db = self._sql.connect(self.db_path)
+        if data is None:
+            db.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+        else:
+            db.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?)", (chat_id, data))
+        db.commit()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, chat_id: str):
+        """Serialize /chat turns of one chat, from the history read to add_exchange."""
+        entry = self._locks.get(chat_id)
+        if entry is None:
+            entry = self._locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[chat_id]
+
+    async def get(self, chat_id: str) -> Conversation:
+        conversation = self._chats.get(chat_id)
+        if conversation is None:
+            conversation = Conversation()
+            if self.db_path:
+                try:
+                    raw = await self._sql.call(self._db_load, chat_id)
+                    if raw:
+                        conversation = Conversation.from_json(raw)
+                except (sqlite3.Error, ValueError) as e:
+                    logging.warning(f"Chat history load failed: {e}")
+            self._chats[chat_id] = conversation
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return conversation
+
+    async def history(self, chat_id: str) -> list:
+        """Messages to send before the new user message."""
+        return (await self.get(chat_id)).to_messages()
+
+    async def add_exchange(self, chat_id: str, user_text: str, reply_text: str):
+        conversation = await self.get(chat_id)
+        # A single huge paste shouldn't wipe the whole history on its own
+        max_turn_chars = self.token_budget * 2
+        conversation.append(True, user_text[:max_turn_chars])
+        conversation.append(False, reply_text[:max_turn_chars])
+        conversation.trim(self.token_budget)
+        if self.db_path:
+            await self._save(chat_id, conversation.to_json())
+
+    async def clear(self, chat_id: str):
+        self._chats.pop(chat_id, None)
+        if self.db_path:
+            await self._save(chat_id, None)
+
+    async def _save(self, chat_id: str, data):
+        try:
+            await self._sql.call(self._db_save, chat_id, data)
+        except sqlite3.Error as e:
+            logging.warning(f"Chat history save failed: {e}")
+
+    def close(self):
+        self._sql.close()
+
+
+conversations = ConversationStore()
+
+
+OUTPUT_MODES = ('image', 'text', 'file')  # how /code delivers code by default
+MODEL_PREFERENCES = ('auto', 'fast', 'smart')
+
+
+class ChatSettings:
+    """One chat's preferences. Records are shared and never mutated; `replace` returns a copy."""
+    __slots__ = ('theme', 'mode', 'model')
+
+    def __init__(self, theme: str = 'default', mode: str = 'image', model: str = 'auto'):
+        self.theme = theme
+        self.mode = mode
+        self.model = model
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return ChatSettings(**values)
+
+
+DEFAULT_CHAT_SETTINGS = ChatSettings()
+
+
+class SettingsStore:
+    """Per-chat settings: an in-memory map in front of SQLite.
+
+    `get` is a dict lookup and never touches the disk. Only chats that changed
+    a setting have a row, so `start()` simply loads them all. `update` changes
+    the in-memory record at once and queues it; a background task writes the
+    queue in one transaction every `flush_interval` seconds and picks up rows
+    written by other bot processes every `refresh_interval` seconds.
+    """
+
+    def __init__(self, db_path: str = SETTINGS_DB, flush_interval: float = SETTINGS_FLUSH_INTERVAL,
+                 refresh_interval: float = SETTINGS_REFRESH_INTERVAL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self._settings = {}  # chat_id -> ChatSettings
+        self._dirty = {}     # chat_id -> ChatSettings not yet written
+        self._last_seen = 0.0
+        self._task = None
+        self._sql = SQLiteExecutor('chat-settings', (
+            # WAL lets several bot processes read while one of them writes
+            "PRAGMA journal_mode=WAL",
+            "CREATE TABLE IF NOT EXISTS chat_settings "
+            "(chat_id TEXT PRIMARY KEY, theme TEXT, mode TEXT, model TEXT, updated REAL)",
+            "CREATE INDEX IF NOT EXISTS chat_settings_updated ON chat_settings (updated)",
+        ))
+        self.flushes = 0
+        self.rows_written = 0
+
+    def _db_load_since(self, since: float):
+        return self._sql.connect(self.db_path).execute(
+            "SELECT chat_id, theme, mode, model, updated FROM chat_settings WHERE updated > ?", (since,)).fetchall()
+
+    def _db_write(self, rows):
+        db = self._sql.connect(self.db_path)
+        with db:
+            db.executemany("INSERT OR REPLACE INTO chat_settings VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get(self, chat_id) -> ChatSettings:
+        return self._settings.get(str(chat_id), DEFAULT_CHAT_SETTINGS)
+
+    def update(self, chat_id, **changes) -> ChatSettings:
+        chat_id = str(chat_id)
+        record = self.get(chat_id).replace(**changes)
+        self._settings[chat_id] = record
+        if self.db_path:
+            self._dirty[chat_id] = record
+        return record
+
+    async def start(self):
+        """Load every stored record and start the write-behind task."""
+        if not self.db_path:
+            return
+        await self._refresh()
+        self._task = asyncio.create_task(self._run())
+
+    async def _refresh(self):
+        # Overlap the window a little: another process may commit a row stamped
+        # just before our previous read finished
+        since = self._last_seen - self.flush_interval - 1
+        try:
+            rows = await self._sql.call(self._db_load_since, since)
+        except sqlite3.Error as e:
+            logging.warning(f"Settings load failed: {e}")
+            return
+        for chat_id, theme, mode, model, updated in rows:
+            self._last_seen = max(self._last_seen, updated)
+            if chat_id not in self._dirty:
+                self._settings[chat_id] = ChatSettings(theme, mode, model)
+
+    async def flush(self):
+        """Write queued changes in a single transaction."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        now = time.time()
+        rows = [(chat_id, r.theme, r.mode, r.model, now) for chat_id, r in batch.items()]
+        try:
+            await self._sql.call(self._db_write, rows)
+        except sqlite3.Error as e:
+            logging.warning(f"Settings flush failed, will retry: {e}")
+            for chat_id, record in batch.items():
+                self._dirty.setdefault(chat_id, record)
+            return
+        self.flushes += 1
+        self.rows_written += len(rows)
+
+    async def _run(self):
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() >= next_refresh:
+                next_refresh = time.monotonic() + self.refresh_interval
+                await self._refresh()
+
+    def stats(self) -> dict:
+        return {'chats': len(self._settings), 'pending': len(self._dirty),
+                'flushes': self.flushes, 'rows_written': self.rows_written}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.db_path:
+            await self.flush()
+        self._sql.close()
+
+
+chat_settings = SettingsStore()
+
+
+# ================= 🚦 ADMISSION CONTROL =================
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)."""
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (min(amount, self.capacity) - self.tokens) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= amount  # may go negative when charging actual usage
+
+    def give_back(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionController:
+    """Decides whether an AI request may call Groq now, later, or not at all.
+
+    Each user and each chat has its own token bucket; an empty bucket means an
+    immediate refusal (`check`, run before the response cache). Only a Groq
+    call is charged (`admit`, run on a cache miss) against global
+    requests-per-minute and tokens-per-minute buckets sized to our Groq quota.
+    When those are exhausted the request waits in a fair queue (round-robin
+    across users, so one heavy user can't starve the rest) for at most
+    ADMISSION_MAX_WAIT seconds. The user and chat buckets are charged as soon
+    as a call is admitted or queued, so waiting requests count against their
+    own user's limit, and refunded if the request is turned away after all.
+    """
+
+    def __init__(self):
+        self._users = {}   # user_id -> TokenBucket
+        self._chats = {}   # chat_id -> TokenBucket
+        now = time.monotonic()
+        self.requests = TokenBucket(GROQ_RPM_BUDGET / 60, GROQ_RPM_BUDGET, now)
+        self.tokens = TokenBucket(GROQ_TPM_BUDGET / 60, GROQ_TPM_BUDGET, now)
+        self._waiting = OrderedDict()  # user_id -> deque of (future, tokens); order = round-robin turn
+        self.queued = 0
+        self._pump_task = None
+        self.admitted = 0
+        self.rejected = Counter()      # reason -> count
+
+    def _bucket(self, table: dict, key, per_min: float, burst: float, now: float) -> TokenBucket:
+        bucket = table.get(key)
+        if bucket is None:
+            if len(table) > 50_000:
+                # Forget full (idle) buckets so the table doesn't grow forever
+                for k in [k for k, b in table.items() if b.wait_time(b.capacity, now) == 0]:
+                    del table[k]
+            bucket = table[key] = TokenBucket(per_min / 60, burst, now)
+        return bucket
+
+    def _global_wait(self, tokens: int, now: float) -> float:
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def charge(self, prompt_tokens: int):
+        """Charge a Groq call that skipped admission (a hedge or retry) to the global budget."""
+        now = time.monotonic()
+        self.requests.take(1, now)
+        self.tokens.take(prompt_tokens, now)
+
+    def record_usage(self, completion_tokens: int):
+        """Charge the completion tokens Groq reported (prompt tokens are charged on admission)."""
+        self.tokens.take(completion_tokens, time.monotonic())
+
+    def _user_buckets(self, user_id, chat_id, now: float) -> list:
+        buckets = []
+        if user_id is not None:
+            buckets.append(self._bucket(self._users, user_id, RATE_USER_PER_MIN, RATE_USER_BURST, now))
+        if chat_id is not None:
+            buckets.append(self._bucket(self._chats, chat_id, RATE_CHAT_PER_MIN, RATE_CHAT_BURST, now))
+        return buckets
+
+    def check(self, user_id, chat_id):
+        """Return the refusal message if this user or chat is over its rate limit, else None.
+        Nothing is charged: a cached answer costs no Groq budget.
+        """
+        now = time.monotonic()
+        wait = max((b.wait_time(1, now) for b in self._user_buckets(user_id, chat_id, now)), default=0)
+        if wait > 0:
+            self.rejected['rate_limited'] += 1
+            return f"⏳ *Slow down!* You can send another AI request in {int(wait) + 1}s."
+        return None
+
+    async def admit(self, prompt_tokens: int, user_id=None, chat_id=None, on_queued=None):
+        """Wait until a Groq call of `prompt_tokens` may proceed; raise AdmissionRefused if it may not.
+        `on_queued(position)` is awaited if the request has to wait for global budget.
+        """
+        refusal = self.check(user_id, chat_id)
+        if refusal:
+            raise AdmissionRefused(refusal)
+
+        now = time.monotonic()
+        requester = self._user_buckets(user_id, chat_id, now)
+        for bucket in requester:
+            bucket.take(1, now)
+        if not self.queued and self._global_wait(prompt_tokens, now) == 0:
+            self._grant(prompt_tokens, now)
+            return
+
+        if self.queued >= ADMISSION_QUEUE_MAX:
+            self._refund(requester)
+            self.rejected['queue_full'] += 1
+            raise AdmissionRefused("🚦 *High traffic:* the AI is at capacity right now. Please retry in a minute.")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append((future, prompt_tokens))
+        self.queued += 1
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        try:
+            if on_queued:
+                try:
+                    await on_queued(self.queued)
+                except Exception as e:
+                    logging.warning(f"Queue notice failed: {e}")
+            await asyncio.wait_for(asyncio.shield(future), timeout=ADMISSION_MAX_WAIT)
+        except asyncio.TimeoutError:
+            if future.done():
+                return  # granted right at the deadline
+            self.rejected['timeout'] += 1
+            raise AdmissionRefused("🚦 *High traffic:* your request waited too long. Please retry in a minute.")
+        finally:
+            # Timed out or cancelled: leave the queue now, so the pump never
+            # grants budget to a request nobody is waiting for
+            if not future.done():
+                future.cancel()
+                self.queued -= 1
+                self._refund(requester)
+
+    def _refund(self, buckets):
+        now = time.monotonic()
+        for bucket in buckets:
+            bucket.give_back(1, now)
+
+    def _grant(self, tokens: int, now: float):
+        self.requests.take(1, now)
+        self.tokens.take(tokens, now)
+        self.admitted += 1
+
+    async def _pump(self):
+        """Grant queued requests round-robin across users as global budget refills."""
+        while self._waiting:
+            user_id, waiters = next(iter(self._waiting.items()))
+            future, tokens = waiters[0]
+            if future.done():  # timed out / cancelled while waiting (admit already left the queue)
+                waiters.popleft()
+            else:
+                now = time.monotonic()
+                wait = self._global_wait(tokens, now)
+                if wait > 0:
+                    await asyncio.sleep(min(wait, 1.0))
+                    continue
+                waiters.popleft()
+                self.queued -= 1
+                self._grant(tokens, now)
+                future.set_result(True)
+            # Next user's turn
+            del self._waiting[user_id]
+            if waiters:
+                self._waiting[user_id] = waiters
+
+    def stats(self) -> dict:
+        return {
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': dict(self.rejected),
+            'requests_available': self.requests.tokens,
+            'tokens_available': self.tokens.tokens,
+        }
+
+
+admission = AdmissionController()
+llm.on_usage = admission.record_usage
+router.on_extra_attempt = admission.charge
+
+
+def collect_component_metrics():
+    """Export the counters kept by the caches, pools and admission control."""
+    yield 'bot_llm_in_flight', 'gauge', (), llm.max_concurrency - llm._slots._value
+    yield 'bot_render_queue_depth', 'gauge', (), render_pool.queue_depth
+    yield 'bot_render_queue_peak', 'gauge', (), render_pool.peak_queue_depth
+    yield 'bot_render_rejected_total', 'counter', (), render_pool.rejected
+    for name, value in render_cache.stats().items():
+        kind = 'gauge' if name in ('entries', 'size_bytes', 'file_ids') else 'counter'
+        suffix = '' if kind == 'gauge' else '_total'
+        yield f'bot_render_cache_{name}{suffix}', kind, (), value
+    stats = subscription_cache.stats()
+    yield 'bot_subscription_cache_hits_total', 'counter', (), stats['hits']
+    yield 'bot_subscription_cache_misses_total', 'counter', (), stats['misses']
+    yield 'bot_subscription_cache_entries', 'gauge', (), stats['entries']
+    for command, stats in response_cache.stats().items():
+        labels = (('command', command),)
+        yield 'bot_response_cache_hits_total', 'counter', labels, stats['hits']
+        yield 'bot_response_cache_misses_total', 'counter', labels, stats['misses']
+        yield 'bot_response_cache_hit_rate', 'gauge', labels, stats['hit_rate']
+    stats = chat_settings.stats()
+    yield 'bot_settings_chats', 'gauge', (), stats['chats']
+    yield 'bot_settings_pending', 'gauge', (), stats['pending']
+    yield 'bot_settings_flushes_total', 'counter', (), stats['flushes']
+    yield 'bot_settings_rows_written_total', 'counter', (), stats['rows_written']
+    yield 'bot_admission_admitted_total', 'counter', (), admission.admitted
+    yield 'bot_admission_queued', 'gauge', (), admission.queued
+    for reason, count in admission.rejected.items():
+        yield 'bot_admission_rejected_total', 'counter', (('reason', reason),), count
+
+
+metrics.collectors.append(collect_component_metrics)
+
+
+class AdmissionRefused(Exception):
+    """Admission control turned a Groq call away; the message is shown to the user as the answer."""
+
+
+# (user_id, chat_id, on_queued) of the AI command being handled, for admit_llm_call
+_ai_requester = contextvars.ContextVar('ai_requester', default=None)
+
+
+async def admit_ai_request(update: Update) -> bool:
+    """Check the user and chat rate limits for an AI command; replies with the reason and returns False if refused.
+    The global Groq budget is charged later, by admit_llm_call, and only if the answer isn't cached.
+    """
+    async def notify(position):
+        await update.message.reply_text(f"🕒 *High traffic:* you're #{position} in the queue, hang tight...",
+                                        parse_mode=ParseMode.MARKDOWN)
+
+    refusal = admission.check(update.effective_user.id, update.effective_chat.id)
+    if refusal:
+        await update.message.reply_text(refusal, parse_mode=ParseMode.MARKDOWN)
+        return False
+    _ai_requester.set((update.effective_user.id, update.effective_chat.id, notify))
+    return True
+
+
+async def admit_llm_call(messages):
+    """Admit a Groq call for `messages` (history included) on behalf of the current AI command."""
+    user_id, chat_id, notify = _ai_requester.get() or (None, None, None)
+    with stage('admission'):
+        await admission.admit(estimate_prompt_tokens(messages), user_id, chat_id, on_queued=notify)
+
+
+AI_ERROR_MARK = "⚡ *System Error:*"
+ADMISSION_MARKS = ("⏳ *Slow down!*", "🚦 *High traffic:*")  # how AdmissionRefused messages start
+
+
+def is_ai_failure(response: str) -> bool:
+    """True if `response` is an error or refusal text rather than an answer from the AI."""
+    return AI_ERROR_MARK in response or response.lstrip().startswith(ADMISSION_MARKS)
+
+
+def _ai_error_text(e: Exception) -> str:
+    """User-facing text for a failed AI call (and count it)."""
+    if isinstance(e, AdmissionRefused):
+        return f"\n\n{e}"
+    if isinstance(e, asyncio.TimeoutError):
+        metrics.inc('bot_llm_errors_total', (('reason', 'timeout'),))
+        return f"\n\n{AI_ERROR_MARK} The AI took too long to answer. Please try again."
+    metrics.inc('bot_llm_errors_total', (('reason', type(e).__name__),))
+    return f"\n\n{AI_ERROR_MARK} Connection interrupted.\nError: {str(e)}"
+
+
+async def get_ai_response(prompt_text, command='chat', history=None, model_pref='auto'):
+    """Sends prompt to Groq API (without blocking the event loop) and returns response.
+    `history` is a list of earlier chat messages. Answers without history are
+    served from / stored in the response cache. `model_pref` is the chat's /model choice.
+    """
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(history or []),
+        {"role": "user", "content": prompt_text}
+    ]
+    route = router.route(command, prompt_text, model_pref)
+
+    async def compute():
+        await admit_llm_call(messages)
+        return await router.complete(messages, route)
+
+    try:
+        with stage('llm'):
+            if history:
+                return await compute()
+            return await response_cache.get_or_compute(
+                command, prompt_text, route.model, GROQ_TEMPERATURE, compute,
+            )
     except Exception as e:
-        # If bot isn't admin or error occurs, allow access (Fail-Safe)
-        logging.error(f"⚠️ Channel Check Error: {e}")
-        return True
+        return _ai_error_text(e).lstrip('\n')
 
-async def get_ai_response(prompt_text):
-    """Sends prompt to Groq API and returns response."""
+async def stream_ai_response(prompt_text, command='chat', history=None, model_pref='auto'):
+    """Async generator version of get_ai_response: yields text chunks as they arrive.
+    A cached answer, or the answer of an identical request already in progress,
+    is yielded in one piece; a complete streamed answer is cached.
+    """
+    route = router.route(command, prompt_text, model_pref)
+    finish = None
+    if not history:
+        try:
+            cached, finish = await response_cache.begin(command, prompt_text, route.model, GROQ_TEMPERATURE)
+        except Exception as e:
+            yield _ai_error_text(e)
+            return
+        if cached is not None:
+            yield cached
+            return
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(history or []),
+        {"role": "user", "content": prompt_text}
+    ]
+    chunks = []
+    text = error = None
     try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt_text}
-            ],
-            model=GROQ_MODEL,
-            temperature=0.7, 
-            max_tokens=2048
-        )
-        return chat_completion.choices[0].message.content
+        await admit_llm_call(messages)
+        async for piece in router.stream(messages, route):
+            chunks.append(piece)
+            yield piece
+        text = "".join(chunks)
     except Exception as e:
-        return f"⚡ *System Error:* Connection interrupted.\nError: {str(e)}"
+        error = e
+        yield _ai_error_text(e)
+    finally:
+        if finish is not None:
+            await finish(text, error)
+
+
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+# ====== Telegram formatting ======
+# Legacy Markdown entities Telegram understands; anything else is literal text
+_MD_LINK_RE = re.compile(r'\[[^\[\]\n]*\]\([^()\s]*\)')
+_MD_MARKERS = '*_`['
+
+
+def markdown_is_valid(text: str) -> bool:
+    """Locally check that `text` parses as Telegram legacy Markdown.
+
+    Conservative on purpose: every *bold*, _italic_, `code`, ```pre``` and
+    [link](url) must be closed and not contain other markers. Anything we
+    are unsure about is reported invalid and goes out as HTML instead, so we
+    never find out from a BadRequest.
+    """
+    i, n = 0, len(text)
+    while i < n:
+        if text.startswith('```', i):
+            end = text.find('```', i + 3)
+            if end < 0:
+                return False
+            i = end + 3
+            continue
+        c = text[i]
+        if c == '\\' and i + 1 < n and text[i + 1] in _MD_MARKERS:
+            i += 2
+        elif c == '`':
+            end = text.find('`', i + 1)
+            if end <= i + 1:
+                return False
+            i = end + 1
+        elif c in '*_':
+            end = text.find(c, i + 1)
+            if end <= i + 1 or any(m in text[i + 1:end] for m in _MD_MARKERS):
+                return False
+            i = end + 1
+        elif c == '[':
+            link = _MD_LINK_RE.match(text, i)
+            if not link:
+                return False
+            i = link.end()
+        else:
+            i += 1
+    return True
+
+
+_FENCE_RE = re.compile(r'```([\w+#.-]*)\n?(.*?)(?:```|\Z)', re.S)
+_INLINE_CODE_RE = re.compile(r'`([^`\n]+)`')
+_BOLD_RE = re.compile(r'\*([^*\n]+)\*')
+
+
+def markdown_to_html(text: str) -> str:
+    """Convert the bot's Markdown dialect to always-valid Telegram HTML.
+    Fences become <pre>, `code` becomes <code>, *bold* becomes <b>; the rest is escaped.
+    """
+    out = []
+    pos = 0
+    for fence in _FENCE_RE.finditer(text):
+        out.append(_inline_markdown_to_html(text[pos:fence.start()]))
+        lang, code = fence.group(1), fence.group(2)
+        css = f' class="language-{html.escape(lang)}"' if lang else ''
+        out.append(f"<pre><code{css}>{html.escape(code.rstrip())}</code></pre>")
+        pos = fence.end()
+    out.append(_inline_markdown_to_html(text[pos:]))
+    return "".join(out)
+
+
+def _inline_markdown_to_html(text: str) -> str:
+    parts = []
+    pos = 0
+    for code in _INLINE_CODE_RE.finditer(text):
+        parts.append(_BOLD_RE.sub(r'<b>\1</b>', html.escape(text[pos:code.start()], quote=False)))
+        parts.append(f"<code>{html.escape(code.group(1), quote=False)}</code>")
+        pos = code.end()
+    parts.append(_BOLD_RE.sub(r'<b>\1</b>', html.escape(text[pos:], quote=False)))
+    return "".join(parts)
+
+
+def format_answer(text: str, watermark: bool = True):
+    """Pick the parse mode once, locally: returns (body, parse_mode) with the watermark inline."""
+    markdown = text + (get_watermark_markdown() if watermark else '')
+    if markdown_is_valid(markdown):
+        return markdown, ParseMode.MARKDOWN
+    metrics.inc('bot_send_fallbacks_total', (('from', 'markdown'), ('to', 'html')))
+    body = markdown_to_html(text) + (html.escape(get_watermark(), quote=False) if watermark else '')
+    return body, ParseMode.HTML
+
+
+def split_text(text: str, limit: int):
+    """Split `text` into pieces of at most `limit` chars, preferring line breaks."""
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+class Segment:
+    """A piece of an AI answer: prose ('text') or a fenced code block ('code')."""
+    __slots__ = ('kind', 'content', 'lang')
+
+    def __init__(self, kind: str, content: str, lang: str = None):
+        self.kind = kind
+        self.content = content
+        self.lang = lang
+
+    def to_markdown(self) -> str:
+        if self.kind == 'code':
+            return f"```{self.lang or ''}\n{self.content}\n```"
+        return self.content
+
+
+def segment_response(text: str) -> list:
+    """Split an answer into prose and code Segments in one pass (unclosed fences run to the end)."""
+    segments = []
+    pos = 0
+    for fence in _FENCE_RE.finditer(text):
+        prose = text[pos:fence.start()].strip('\n')
+        if prose.strip():
+            segments.append(Segment('text', prose))
+        code = fence.group(2).strip('\n')
+        if code.strip():
+            segments.append(Segment('code', code, fence.group(1).lower() or None))
+        pos = fence.end()
+    tail = text[pos:].strip('\n')
+    if tail.strip():
+        segments.append(Segment('text', tail))
+    return segments
+
+
+def chunk_segments(segments, limit: int) -> list:
+    """Pack segments into Markdown messages of at most `limit` chars.
+    Code blocks that don't fit are split and each piece re-fenced, so every
+    chunk stays well-formed on its own.
+    """
+    def parts():
+        for seg in segments:
+            if seg.kind == 'code':
+                overhead = len(Segment('code', '', seg.lang).to_markdown())
+                for piece in split_text(seg.content, limit - overhead):
+                    yield Segment('code', piece, seg.lang).to_markdown()
+            else:
+                yield from split_text(seg.content, limit)
+
+    chunks = []
+    current = ''
+    for part in parts():
+        if current and len(current) + 2 + len(part) > limit:
+            chunks.append(current)
+            current = part
+        else:
+            current = f"{current}\n\n{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def _deliver_segments(update: Update, segments, status=None):
+    """Send segments as one or more text messages; the watermark goes on the last one."""
+    # Room for the watermark and for HTML tags if a chunk has to be converted
+    limit = TELEGRAM_TEXT_LIMIT - len(get_watermark_markdown()) - 200
+    pieces = chunk_segments(segments, limit)
+    for i, piece in enumerate(pieces):
+        await _deliver_text(update, piece, status=status if i == 0 else None, watermark=i == len(pieces) - 1)
+
+
+async def _deliver_text(update: Update, text: str, status=None, watermark: bool = True):
+    """Send one formatted text message, editing `status` into it when given (one API call)."""
+    body, parse_mode = format_answer(text, watermark=watermark)
+    try:
+        if status is not None:
+            return await status.edit_text(body, parse_mode=parse_mode, disable_web_page_preview=True)
+        return await update.message.reply_text(body, parse_mode=parse_mode, disable_web_page_preview=True)
+    except BadRequest as e:
+        # Local validation missed something: last resort is plain text, watermark still inline
+        metrics.inc('bot_send_fallbacks_total', (('from', parse_mode.lower()), ('to', 'plain')))
+        logging.warning(f"{parse_mode} send failed ({e}), sending plain text.")
+        plain = text + (get_watermark() if watermark else '')
+        if status is not None:
+            return await status.edit_text(plain, parse_mode=None, disable_web_page_preview=True)
+        return await update.message.reply_text(plain, parse_mode=None, disable_web_page_preview=True)
+
+
+async def _delete_quietly(message):
+    try:
+        await message.delete()
+    except Exception as e:
+        logging.warning(f"Could not delete status message: {e}")
+
+
+async def stream_ai_reply(update: Update, status, prompt_text: str, command: str = 'chat', history=None,
+                          prefer_image_for_code: bool = True) -> str:
+    """Stream the AI answer into the `status` message, then format it once at the end.
+
+    Intermediate edits are plain text, coalesced and sent at most every
+    STREAM_EDIT_INTERVAL seconds to stay under Telegram's edit limits.
+    The final answer goes through send_smart_response like a non-streamed
+    one, so code blocks still arrive as images unless `prefer_image_for_code`
+    is False. Returns the full response text.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = []
+    total = shown = 0
+    next_edit = loop.time()
+
+    started = loop.time()
+    model_pref = chat_settings.get(update.effective_chat.id).model
+    async for piece in stream_ai_response(prompt_text, command=command, history=history, model_pref=model_pref):
+        if not chunks:
+            metrics.observe('bot_llm_first_token_seconds', loop.time() - started, (('command', command),))
+        chunks.append(piece)
+        total += len(piece)
+        now = loop.time()
+        if now < next_edit or total - shown < STREAM_MIN_NEW_CHARS:
+            continue
+        preview = "".join(chunks)[:TELEGRAM_TEXT_LIMIT - 2]
+        try:
+            await status.edit_text(preview + " ▌", parse_mode=None, disable_web_page_preview=True)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            next_edit = now + float(retry_after)
+            continue
+        except BadRequest:
+            pass
+        shown = total
+        next_edit = loop.time() + STREAM_EDIT_INTERVAL
+
+    response = "".join(chunks)
+    await send_smart_response(update, response, prefer_image_for_code=prefer_image_for_code, status=status)
+    return response
 
-async def send_smart_response(update: Update, text: str, prefer_image_for_code: bool = True):
+
+async def send_smart_response(update: Update, text: str, prefer_image_for_code: bool = True, status=None):
     """
     Sends message with MARKDOWN formatting + Watermark.
     - If the text contains large code blocks or markdown code fences and Pygments is available,
       it will send a syntax-highlighted image instead (better colors on Telegram).
-    - Falls back to Markdown or plain text on errors.
+    - The parse mode is chosen locally (Markdown if it validates, else HTML),
+      so a normal answer costs exactly one API call.
+    - If `status` (the "⚡ Working..." message) is given it is edited into the
+      answer instead of being deleted and replaced.
     """
-    final_text = text + get_watermark_markdown()
+    # If Pygments is available and text looks like code, send code blocks as images
+    if prefer_image_for_code and PYGMENTS_AVAILABLE and not is_ai_failure(text) and looks_like_code(text):
+        caption = f"{BOT_NAME} • Code (image)"
+        await send_segmented_response(update, text, status=status, caption=caption)
+        return
 
-    # If Pygments is available and text looks like code, try sending an image
-    is_code_like = '```' in text or (len(text) > 800 and '\n' in text and any(k in text.lower() for k in ['def ', 'class ', 'import ', 'function', '{', ';']))
-    if prefer_image_for_code and PYGMENTS_AVAILABLE and is_code_like:
+    with stage('send'):
         try:
-            img = render_code_image(text)
-            img.seek(0)
-            caption = f"{BOT_NAME} • Code (image)" + get_watermark()
-            await update.message.reply_photo(photo=img, caption=caption)
-            return
+            await _deliver_segments(update, segment_response(text), status=status)
         except Exception as e:
-            logging.warning(f"Code image generation failed: {e}")
-
-    try:
-        await update.message.reply_text(final_text, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
-    except BadRequest:
-        # Try HTML version
-        try:
-            html_text = text + get_watermark()
-            await update.message.reply_text(html_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-            return
-        except BadRequest:
-            try:
-                logging.warning("Markdown/HTML failed, sending plain text and watermark separately.")
-                await update.message.reply_text(text, parse_mode=None, disable_web_page_preview=True)
-                await update.message.reply_text(get_watermark(), parse_mode=None)
-            except Exception as e:
-                logging.error(f"Final Send Error: {e}")
-    except Exception as e:
-        logging.error(f"Unexpected Error: {e}")
+            logging.error(f"Final Send Error: {e}")
 
 
 # ====== Color / Theme helpers ======
-CHAT_THEMES = {}  # simple in-memory map: chat_id -> pygments style name
-
 DEFAULT_STYLE = 'monokai'
+CODE_FONT_SIZE = 14
 STYLE_MAP = {
     'red': 'fruity',
     'blue': 'monokai',
@@ -167,46 +1922,138 @@ STYLE_MAP = {
     'default': DEFAULT_STYLE,
 }
 
-def render_code_image(code_text: str, style: str = None) -> BytesIO:
+# ====== Language detection ======
+GUESS_SAMPLE_CHARS = 2000  # guess_lexer only ever sees this much code
+
+SHEBANG_RE = re.compile(r'^#!\s*\S*?(?:/env\s+)?/?(?:\S*/)?(python|bash|sh|zsh|node|php|ruby|perl)[\d.]*\b')
+SHEBANG_LANGS = {'python': 'python', 'bash': 'bash', 'sh': 'bash', 'zsh': 'bash', 'node': 'javascript',
+                 'php': 'php', 'ruby': 'ruby', 'perl': 'perl'}
+
+# language -> [(regex, weight)]; a language needs a total weight of 2 to win
+LANGUAGE_CUES = {
+    'python': [(r'^\s*def \w+\(.*\)\s*(->.*)?:\s*$', 2), (r'^\s*(from [\w.]+ )?import \w', 1),
+               (r'^\s*class \w+(\(.*\))?:\s*$', 2), (r'\bself\.', 1), (r'^\s*(elif|except)\b.*:', 2),
+               (r'__name__\s*==', 2), (r'\bprint\(', 1)],
+    'javascript': [(r'\b(const|let|var) \w+\s*=', 1), (r'=>', 1), (r'console\.log\(', 2),
+                   (r'\brequire\([\'"]', 2), (r'\bdocument\.\w+', 2), (r'^\s*function\s*\w*\(', 1),
+                   (r'\bexport (default|const|function)\b', 2)],
+    'typescript': [(r'\binterface \w+\s*\{', 2), (r'\w+\s*:\s*(string|number|boolean|any)\b', 2)],
+    'php': [(r'<\?php', 3), (r'\$\w+\s*=', 1), (r'\becho\b', 1), (r'->\w+\(', 1)],
+    'html': [(r'<!DOCTYPE html', 3), (r'<(html|head|body|div|span|script)\b', 2)],
+    'css': [(r'^\s*[.#]?[\w-]+(\s*[.#:>]?[\w-]+)*\s*\{\s*$', 1), (r'^\s*[\w-]+\s*:\s*[^;{]+;\s*$', 1)],
+    'java': [(r'\bpublic (static )?(class|void|final)\b', 2), (r'System\.out\.print', 3)],
+    'c': [(r'#include\s*<\w+\.h>', 3), (r'\bprintf\(', 1), (r'\bint main\s*\(', 1)],
+    'cpp': [(r'#include\s*<(iostream|vector|string|map)>', 3), (r'\bstd::', 2), (r'\bcout\s*<<', 2)],
+    'csharp': [(r'\busing System\b', 3), (r'\bConsole\.Write', 3), (r'\bnamespace \w+', 1)],
+    'go': [(r'^package \w+\s*$', 2), (r'\bfunc (\(.*\) )?\w+\(', 2), (r':=', 1), (r'\bfmt\.', 2)],
+    'rust': [(r'\bfn \w+\(', 2), (r'\blet mut\b', 2), (r'\bprintln!\(', 3), (r'\bimpl\b', 1)],
+    'ruby': [(r'^\s*def \w+(\(.*\))?\s*$', 1), (r'^\s*end\s*$', 1), (r'\bputs\b', 2), (r'\.each do\b', 2)],
+    'bash': [(r'^\s*(sudo|apt(-get)?|pip3?|npm|cd|export|chmod|curl|wget)\s', 2), (r'^\s*echo\s', 1),
+             (r'\bfi\s*$', 2), (r'\$\{\w+\}', 1)],
+    'sql': [(r'\bSELECT\b[\s\S]+?\bFROM\b', 2), (r'\bINSERT INTO\b', 2), (r'\bCREATE TABLE\b', 3),
+            (r'\bWHERE\b', 1)],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _cue_index():
+    """LANGUAGE_CUES compiled on first use rather than at import."""
+    return [(lang, [(re.compile(p, re.M), w) for p, w in cues]) for lang, cues in LANGUAGE_CUES.items()]
+
+
+def heuristic_language(code: str, sample_chars: int = GUESS_SAMPLE_CHARS):
+    """Cheap language guess from shebangs and keyword cues. Returns a Pygments alias or None."""
+    sample = code[:sample_chars]
+    shebang = SHEBANG_RE.match(sample.lstrip())
+    if shebang:
+        return SHEBANG_LANGS[shebang.group(1)]
+
+    best, best_score = None, 1
+    for lang, cues in _cue_index():
+        score = sum(weight for regex, weight in cues if regex.search(sample))
+        if score > best_score:
+            best, best_score = lang, score
+    return best
+
+
+def looks_like_code(text: str) -> bool:
+    """True for fenced answers or long unfenced text that the heuristic index recognises as code."""
+    return '```' in text or (len(text) > 800 and '\n' in text and heuristic_language(text) is not None)
+
+
+@functools.lru_cache(maxsize=128)
+def get_cached_lexer(name: str):
+    """Pygments lexer for alias `name` (instances are reusable), or None if unknown."""
+    try:
+        from pygments.lexers import get_lexer_by_name
+        return get_lexer_by_name(name)
+    except Exception:
+        return None
+
+
+def resolve_lexer(code: str, hint: str = None):
+    """Pick a lexer: fence hint -> heuristic index -> guess_lexer on a sample -> plain text."""
+    if hint:
+        lexer = get_cached_lexer(hint.lower())
+        if lexer is not None:
+            return lexer
+
+    lang = heuristic_language(code)
+    if lang:
+        lexer = get_cached_lexer(lang)
+        if lexer is not None:
+            return lexer
+
+    try:
+        from pygments.lexers import guess_lexer
+        guessed = guess_lexer(code[:GUESS_SAMPLE_CHARS])
+        lexer = get_cached_lexer(guessed.aliases[0]) if guessed.aliases else guessed
+        if lexer is not None:
+            return lexer
+    except Exception:
+        pass
+    return get_cached_lexer('text')
+
+
+_formatters = threading.local()
+
+
+def get_image_formatter(style: str, font_size: int = CODE_FONT_SIZE):
+    """ImageFormatter per (style, font size), cached per thread.
+
+    Building one looks the font up on disk, so we keep them around. They are
+    not thread-safe and collect drawables across calls, hence the per-thread
+    cache and the reset before each use.
+    """
+    cache = getattr(_formatters, 'cache', None)
+    if cache is None:
+        cache = _formatters.cache = {}
+    formatter = cache.get((style, font_size))
+    if formatter is None:
+        from pygments.formatters import ImageFormatter
+        formatter = ImageFormatter(style=style, font_name='DejaVu Sans Mono', line_numbers=False, font_size=font_size)
+        cache[(style, font_size)] = formatter
+    formatter.drawables = []
+    return formatter
+
+
+def render_code_image(code_text: str, style: str = None, language: str = None) -> BytesIO:
     """Render syntax-highlighted PNG of given code using Pygments ImageFormatter.
     Returns a BytesIO containing PNG data. Raises if pygments not available.
+    `language` is used as the lexer hint when `code_text` is bare code.
     """
     if not PYGMENTS_AVAILABLE:
         raise RuntimeError('Pygments not installed')
+    from pygments import highlight
 
-    # Try to extract code from triple backticks if present
-    if '```' in code_text:
-        try:
-            parts = code_text.split('```')
-            # prefer the first fenced block or last non-empty
-            fenced = next((p for p in parts if p.strip() and '\n' in p), parts[-1])
-            # Sometimes the first line is language name
-            if '\n' in fenced:
-                first, rest = fenced.split('\n', 1)
-                if first.strip().isalpha():
-                    lang_hint = first.strip()
-                    code = rest
-                else:
-                    code = fenced
-            else:
-                code = fenced
-        except Exception:
-            code = code_text
-    else:
-        code = code_text
-
-    # Guess lexer
-    try:
-        lexer = guess_lexer(code)
-    except Exception:
-        try:
-            lexer = get_lexer_by_name('python')
-        except Exception:
-            lexer = None
+    # Try to extract code (and the language hint) from triple backticks if present
+    code, lang_hint = extract_fenced_code(code_text)
+    if not code:
+        code, lang_hint = code_text, language
 
-    style_name = style or DEFAULT_STYLE
-    formatter = ImageFormatter(style=style_name, font_name='DejaVu Sans Mono', line_numbers=False, font_size=14)
-    data = highlight(code, lexer, formatter) if lexer else highlight(code, get_lexer_by_name('text'), formatter)
+    lexer = resolve_lexer(code, lang_hint)
+    formatter = get_image_formatter(style or DEFAULT_STYLE)
+    data = highlight(code, lexer, formatter)
 
     bio = BytesIO()
     bio.write(data)
@@ -215,12 +2062,433 @@ def render_code_image(code_text: str, style: str = None) -> BytesIO:
     return bio
 
 
+def encode_code_image(png: bytes, line_height: int, padding: int, image_format: str = None) -> list:
+    """Shrink a rendered PNG for upload and cut it into tiles of at most RENDER_MAX_TILE_HEIGHT px.
+
+    Tiles are cut between text lines. PNG output is palette-quantized and
+    optimized (anti-aliased code needs only a few dozen colours); WEBP output
+    is lossless. Returns the encoded tiles as bytes.
+    """
+    from PIL import Image
+    image_format = (image_format or RENDER_IMAGE_FORMAT).upper()
+    image = Image.open(BytesIO(png))
+    image.load()
+    width, height = image.size
+
+    boxes = [(0, 0, width, height)]
+    if height > RENDER_MAX_TILE_HEIGHT:
+        lines_per_tile = max(1, (RENDER_MAX_TILE_HEIGHT - 2 * padding) // line_height)
+        step = lines_per_tile * line_height
+        boxes = []
+        top = 0
+        while top < height:
+            bottom = padding + (len(boxes) + 1) * step
+            if bottom + padding >= height:
+                bottom = height
+            boxes.append((0, top, width, bottom))
+            top = bottom
+
+    tiles = []
+    for box in boxes:
+        tile = image.crop(box) if box != (0, 0, width, height) else image
+        out = BytesIO()
+        if image_format == 'WEBP':
+            tile.save(out, format='WEBP', lossless=True, method=4)
+        else:
+            tile = tile.convert('RGB').quantize(colors=RENDER_PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+            tile.save(out, format='PNG', optimize=True)
+        tiles.append(out.getvalue())
+    return tiles
+
+
+def _render_code_tiles(code_text: str, style: str = None, language: str = None):
+    """Worker entry point for RenderPool: render + encode, returning picklable
+    (tiles, raw PNG size, encode seconds).
+    """
+    raw = render_code_image(code_text, style=style, language=language).getvalue()
+    formatter = get_image_formatter(style or DEFAULT_STYLE)
+    started = time.perf_counter()
+    tiles = encode_code_image(raw, formatter.fonth + formatter.line_pad, formatter.image_pad)
+    return tiles, len(raw), time.perf_counter() - started
+
+
+def _warm_up_renderer(lexers=WARMUP_LEXERS) -> bool:
+    """Worker-side warm-up: import Pygments + PIL, load the font into this
+    worker's ImageFormatter and build the common lexers.
+    """
+    for name in lexers:
+        get_cached_lexer(name)
+    get_image_formatter(DEFAULT_STYLE)
+    importlib.import_module('PIL.PngImagePlugin')
+    return True
+
+
+class RenderPoolSaturated(RuntimeError):
+    """Raised when too many code images are already waiting to be rendered."""
+
+
+class RenderPool:
+    """Bounded off-loop executor for render_code_image.
+
+    Pygments + PIL are CPU-bound, so rendering runs in worker processes (or
+    threads) instead of on the event loop. At most `max_pending` renders can be
+    queued or running; beyond that `render` raises RenderPoolSaturated so the
+    caller can send text instead of making the user wait.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, max_pending: int = RENDER_MAX_PENDING,
+                 use_processes: bool = RENDER_USE_PROCESSES):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.use_processes = use_processes
+        self._executor = None
+        self.queue_depth = 0       # renders currently queued or running
+        self.peak_queue_depth = 0
+        self.rejected = 0          # renders refused because the pool was full
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                # spawn, like the shard workers: the pool is first built after the
+                # event loop and the SQLite/to_thread threads are already running
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+        return self._executor
+
+    async def render(self, code_text: str, style: str = None, language: str = None) -> list:
+        """Render a code image off the event loop. Returns the encoded tiles (bytes)."""
+        if self.queue_depth >= self.max_pending:
+            self.rejected += 1
+            logging.warning(f"Render pool saturated ({self.queue_depth} pending), falling back to text")
+            raise RenderPoolSaturated('render pool saturated')
+
+        self.queue_depth += 1
+        self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        loop = asyncio.get_running_loop()
+        try:
+            tiles, raw_size, encode_seconds = await loop.run_in_executor(
+                self._get_executor(), _render_code_tiles, code_text, style, language)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge snippet): start a fresh pool next time
+            self._executor = None
+            raise
+        finally:
+            self.queue_depth -= 1
+
+        metrics.observe('bot_render_encode_seconds', encode_seconds)
+        metrics.inc('bot_render_raw_bytes_total', value=raw_size)
+        metrics.inc('bot_render_encoded_bytes_total', value=sum(map(len, tiles)))
+        for tile in tiles:
+            metrics.observe('bot_render_image_bytes', len(tile), buckets=SIZE_BUCKETS)
+        return tiles
+
+    async def warm_up(self):
+        """Start the workers and preload each of them (one warm-up task per worker, best effort)."""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, _warm_up_renderer) for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+render_pool = RenderPool()
+
+
+class RenderCache:
+    """Content-addressed cache for rendered code images.
+
+    Keys are sha256(code) + style + font size + language. The encoded image
+    tiles live in an LRU bounded by total size, optionally mirrored to
+    RENDER_CACHE_DIR. Once Telegram has stored the photos we also keep their
+    `file_id`s, so a repeat send needs neither a render nor an upload.
+    """
+
+    def __init__(self, max_bytes: int = RENDER_CACHE_MAX_BYTES, max_file_ids: int = RENDER_CACHE_MAX_FILE_IDS,
+                 cache_dir: str = RENDER_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self.cache_dir = cache_dir
+        self._images = OrderedDict()    # key -> tuple of encoded tiles
+        self._file_ids = OrderedDict()  # key -> tuple of Telegram file_ids, one per tile
+        self.size_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.file_id_hits = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(code_text: str, style: str = None, font_size: int = CODE_FONT_SIZE, language: str = None) -> str:
+        digest = hashlib.sha256(code_text.encode('utf-8')).hexdigest()
+        return (f"{digest}-{style or DEFAULT_STYLE}-{font_size}-{language or 'auto'}"
+                f"-{RENDER_IMAGE_FORMAT.lower()}{RENDER_MAX_TILE_HEIGHT}")
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.tiles")
+
+    def _store(self, key: str, tiles: tuple):
+        if key in self._images:
+            self.size_bytes -= sum(map(len, self._images.pop(key)))
+        self._images[key] = tiles
+        self.size_bytes += sum(map(len, tiles))
+        while self.size_bytes > self.max_bytes and self._images:
+            _, evicted = self._images.popitem(last=False)
+            self.size_bytes -= sum(map(len, evicted))
+
+    async def get(self, key: str):
+        """Return the cached tiles for `key`, or None."""
+        data = self._images.get(key)
+        if data is not None:
+            self._images.move_to_end(key)
+            self.hits += 1
+            return data
+        if self.cache_dir:
+            try:
+                data = await asyncio.to_thread(_read_file, self._disk_path(key))
+                data = _unpack_tiles(data)
+            except (OSError, ValueError):
+                data = None
+            if data is not None:
+                self._store(key, data)
+                self.disk_hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, tiles):
+        tiles = tuple(tiles)
+        self._store(key, tiles)
+        if self.cache_dir:
+            try:
+                await asyncio.to_thread(_write_file, self._disk_path(key), _pack_tiles(tiles))
+            except OSError as e:
+                logging.warning(f"Render cache write failed: {e}")
+
+    def get_file_id(self, key: str):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id
+
+    def set_file_id(self, key: str, file_ids: tuple):
+        self._file_ids[key] = tuple(file_ids)
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_file_ids:
+            self._file_ids.popitem(last=False)
+
+    def forget_file_id(self, key: str):
+        self._file_ids.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'file_id_hits': self.file_id_hits,
+            'entries': len(self._images),
+            'size_bytes': self.size_bytes,
+            'file_ids': len(self._file_ids),
+        }
+
+
+def _pack_tiles(tiles) -> bytes:
+    """Length-prefixed concatenation of tiles (the on-disk cache format)."""
+    return b"".join(len(t).to_bytes(4, 'big') + t for t in tiles)
+
+
+def _unpack_tiles(data: bytes) -> tuple:
+    tiles = []
+    pos = 0
+    while pos < len(data):
+        size = int.from_bytes(data[pos:pos + 4], 'big')
+        if size <= 0 or pos + 4 + size > len(data):
+            raise ValueError('corrupt render cache file')
+        tiles.append(data[pos + 4:pos + 4 + size])
+        pos += 4 + size
+    if not tiles:
+        raise ValueError('empty render cache file')
+    return tuple(tiles)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+render_cache = RenderCache()
+
+
+async def _code_image_input(code_text: str, style: str = None, language: str = None):
+    """Return (cache key, photos): the known Telegram file_ids for this render,
+    or freshly encoded tiles as named BytesIO objects.
+    """
+    key = render_cache.key(code_text, style, language=language)
+    file_ids = render_cache.get_file_id(key)
+    if file_ids:
+        return key, list(file_ids)
+
+    tiles = await render_cache.get(key)
+    if tiles is None:
+        try:
+            with stage('render'):
+                tiles = await render_pool.render(code_text, style=style, language=language)
+        except Exception as e:
+            metrics.inc('bot_render_failures_total', (('reason', type(e).__name__),))
+            raise
+        await render_cache.put(key, tiles)
+
+    photos = []
+    for i, data in enumerate(tiles):
+        img = BytesIO(data)
+        img.name = f"code{i + 1}.{RENDER_IMAGE_FORMAT.lower()}"
+        photos.append(img)
+    return key, photos
+
+
+TELEGRAM_MEDIA_GROUP_MAX = 10
+
+
+def _media_groups(items: list) -> list:
+    """Split `items` into the fewest groups of at most 10, as even as possible,
+    so no group is left with a single item (sendMediaGroup needs 2-10).
+    """
+    count = -(-len(items) // TELEGRAM_MEDIA_GROUP_MAX)
+    size, extra = divmod(len(items), count)
+    groups, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+
+async def _send_photos(message, photos, caption: str = None):
+    """Send up to 10 photos as one photo or one media group; returns the sent messages."""
+    with stage('send'):
+        if len(photos) == 1:
+            return [await message.reply_photo(photo=photos[0], caption=caption)]
+        media = [InputMediaPhoto(media=photo, caption=caption if i == 0 else None) for i, photo in enumerate(photos)]
+        return list(await message.reply_media_group(media=media))
+
+
+async def send_code_images(message, blocks, style: str = None, caption: str = None):
+    """Render every code block concurrently and send the images (tiles included)
+    as a single photo or media group(s).
+
+    `blocks` are Segments of kind 'code'. Returns the blocks that were not
+    delivered as images (render error, pool saturated, over RENDER_MAX_IMAGES,
+    failed send) so the caller can send them as text.
+    """
+    async def inputs(selected):
+        results = await asyncio.gather(*(_code_image_input(b.content, style, b.lang) for b in selected),
+                                       return_exceptions=True)
+        for e in results:
+            if isinstance(e, BaseException):
+                logging.warning(f"Code block render failed: {e}")
+        ready = [(b, r) for b, r in zip(selected, results) if not isinstance(r, BaseException)]
+        failed = {b for b, r in zip(selected, results) if isinstance(r, BaseException)}
+        return ready, failed
+
+    async def send(ready, caption):
+        """Send the tiles of `ready` blocks group by group.
+        Returns (undelivered blocks, blocks whose cached file_id was rejected, caption if still unsent).
+        """
+        items = [(block, key, photo) for block, (key, photos) in ready for photo in photos]
+        undelivered, stale = set(), set()
+        uploaded = {}
+        for group in _media_groups(items) if items else []:
+            try:
+                sent = await _send_photos(message, [photo for _, _, photo in group], caption=caption)
+            except Exception as e:
+                if isinstance(e, BadRequest) and any(isinstance(photo, str) for _, _, photo in group):
+                    # A stale file_id spoils the whole group: forget them and upload fresh renders
+                    for _, key, photo in group:
+                        if isinstance(photo, str):
+                            render_cache.forget_file_id(key)
+                    stale.update(block for block, _, _ in group)
+                else:
+                    logging.warning(f"Sending code images failed: {e}")
+                    undelivered.update(block for block, _, _ in group)
+                continue
+            caption = None
+            # Remember file_ids of fresh uploads so the next send skips render + upload
+            for (_, key, photo), msg in zip(group, sent):
+                if not isinstance(photo, str) and msg and msg.photo:
+                    uploaded.setdefault(key, []).append(msg.photo[-1].file_id)
+        for _, (key, photos) in ready:
+            if len(uploaded.get(key, ())) == len(photos):
+                render_cache.set_file_id(key, uploaded[key])
+        return undelivered, stale - undelivered, caption
+
+    ready, failed = await inputs(blocks)
+    budget = RENDER_MAX_IMAGES
+    kept = []
+    for block, (key, photos) in ready:
+        if len(photos) <= budget:
+            kept.append((block, (key, photos)))
+            budget -= len(photos)
+        else:
+            failed.add(block)
+    if len(kept) < len(ready):
+        logging.info(f"Answer needs more than {RENDER_MAX_IMAGES} images, sending the rest as text")
+
+    undelivered, stale, caption = await send(kept, caption)
+    failed |= undelivered
+    if stale:
+        retry, retry_failed = await inputs([b for b in blocks if b in stale])
+        undelivered, stale, _ = await send(retry, caption)
+        failed |= retry_failed | undelivered | stale
+    return [b for b in blocks if b in failed]
+
+
+async def send_segmented_response(update: Update, text: str, style: str = None, status=None,
+                                  caption: str = None):
+    """Deliver an answer in full: every code block as images (media groups),
+    the prose (plus any block not delivered as an image) as chunked text.
+    `status` is edited into the first text chunk, or deleted if there is no text.
+    """
+    segments = segment_response(text)
+    blocks = [seg for seg in segments if seg.kind == 'code']
+    if not blocks:
+        # Unfenced code: the whole answer is one block
+        blocks = segments = [Segment('code', text.strip('\n'), heuristic_language(text))]
+
+    if caption and not any(seg.kind == 'text' for seg in segments):
+        caption += get_watermark()  # no text message will carry it
+    try:
+        failed = await send_code_images(update.message, blocks, style=style, caption=caption)
+    except Exception as e:
+        logging.warning(f"Code images failed, sending text: {e}")
+        failed = blocks
+
+    remaining = [seg for seg in segments if seg.kind == 'text' or seg in failed]
+    if remaining:
+        await _deliver_segments(update, remaining, status=status)
+    elif status is not None:
+        await _delete_quietly(status)
+
+
 def extract_fenced_code(response: str):
     """Try to extract fenced code and optional language hint from AI response."""
     if '```' in response:
         try:
+            # Odd-indexed parts are inside fences; the rest is prose around them
             parts = response.split('```')
-            fenced = next((p for p in parts if '\n' in p), parts[-1])
+            fenced = next((p for p in parts[1::2] if '\n' in p), parts[1])
             if fenced.strip():
                 if '\n' in fenced:
                     first, rest = fenced.split('\n', 1)
@@ -246,26 +2514,28 @@ async def handle_code_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # If there's a fenced code block in message reply or text, use it; otherwise, ask AI to generate
     incoming = update.message.text.replace('/codeimg', '').strip()
+    status = None
     if '```' in incoming:
         code_text = incoming
     else:
         # treat remaining text as a prompt
         prompt = incoming or 'Create a short python example'
+        if not await admit_ai_request(update): return
         status = await update.message.reply_text("⚡ Generating code image...", parse_mode=ParseMode.MARKDOWN)
-        response = await get_ai_response(f"Write a concise code example for: {prompt}")
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
+        response = await get_ai_response(f"Write a concise code example for: {prompt}", command='codeimg', model_pref=chat_settings.get(update.effective_chat.id).model)
+        if is_ai_failure(response):
+            await send_smart_response(update, response, prefer_image_for_code=False, status=status)
+            return
         code_text = response
 
     # determine style from chat settings
-    chat_id = str(update.effective_chat.id)
-    style = STYLE_MAP.get(CHAT_THEMES.get(chat_id, 'default'), DEFAULT_STYLE)
+    style = STYLE_MAP.get(chat_settings.get(update.effective_chat.id).theme, DEFAULT_STYLE)
 
     try:
-        img = render_code_image(code_text, style=style)
-        await update.message.reply_photo(photo=img, caption=f"{BOT_NAME} • Code (image)")
+        await send_segmented_response(update, code_text, style=style, status=status, caption=f"{BOT_NAME} • Code (image)")
     except Exception as e:
         logging.error(f"Code image send error: {e}")
-        await send_smart_response(update, code_text)
+        await send_smart_response(update, code_text, prefer_image_for_code=False, status=status)
 
 
 async def handle_theme(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -275,7 +2545,7 @@ async def handle_theme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
 
     if not args:
-        current = CHAT_THEMES.get(chat_id, 'default')
+        current = chat_settings.get(chat_id).theme
         await update.message.reply_text(f"🎨 Current theme: {current}. Available: red, blue, pink, default")
         return
 
@@ -284,9 +2554,49 @@ async def handle_theme(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Invalid theme. Choose from: red, blue, pink, default")
         return
 
-    CHAT_THEMES[chat_id] = choice
+    chat_settings.update(chat_id, theme=choice)
     await update.message.reply_text(f"✅ Theme set to: {choice}")
 
+
+async def handle_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set how /code delivers code in this chat (`image`, `text`, `file`)."""
+    if not await check_subscription(update, context): return
+    args = context.args
+    chat_id = str(update.effective_chat.id)
+
+    if not args:
+        current = chat_settings.get(chat_id).mode
+        await update.message.reply_text(f"📦 Current output mode: {current}. Available: {', '.join(OUTPUT_MODES)}")
+        return
+
+    choice = args[0].lower()
+    if choice not in OUTPUT_MODES:
+        await update.message.reply_text(f"❌ Invalid mode. Choose from: {', '.join(OUTPUT_MODES)}")
+        return
+
+    chat_settings.update(chat_id, mode=choice)
+    await update.message.reply_text(f"✅ Output mode set to: {choice}")
+
+
+async def handle_model(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pick the model for this chat: `auto` (by prompt), `fast` or `smart`."""
+    if not await check_subscription(update, context): return
+    args = context.args
+    chat_id = str(update.effective_chat.id)
+
+    if not args:
+        current = chat_settings.get(chat_id).model
+        await update.message.reply_text(f"🧠 Current model: {current}. Available: {', '.join(MODEL_PREFERENCES)}")
+        return
+
+    choice = args[0].lower()
+    if choice not in MODEL_PREFERENCES:
+        await update.message.reply_text(f"❌ Invalid model. Choose from: {', '.join(MODEL_PREFERENCES)}")
+        return
+
+    chat_settings.update(chat_id, model=choice)
+    await update.message.reply_text(f"✅ Model set to: {choice}")
+
 # ================= 🎮 COMMAND HANDLERS =================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -318,9 +2628,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📋 `/plan (idea)` - Get a Project Roadmap\n"
         f"🔒 `/audit (code)` - Check Security Vulnerabilities\n"
         f"📝 `/prompt (topic)` - Generate AI Prompts\n"
-        f"💬 `/chat` - Developer Mode Chat\n\n"
+        f"💬 `/chat` - Developer Mode Chat\n"
+        f"🧹 `/reset` - Clear chat memory\n\n"
         f"🖼 `/codeimg` - Generate syntax-highlighted code image\n"
-        f"🎨 `/theme` - Set code image theme (red, blue, pink)\n\n"
+        f"🎨 `/theme` - Set code image theme (red, blue, pink)\n"
+        f"📦 `/mode` - Default /code output (image, text, file)\n"
+        f"🧠 `/model` - Choose the AI model (auto, fast, smart)\n\n"
         f"🛡 _System Online. Waiting for input..._"
     )
     
@@ -335,19 +2648,36 @@ async def handle_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("💻 *Usage:* `/code python telegram bot` (use `--text` to get plain text, `--file` to download)", parse_mode=ParseMode.MARKDOWN)
         return
 
-    # flags
+    # flags override the chat's /mode
     raw_text = update.message.text or ''
-    want_file = raw_text.strip().lower().startswith('/codefile') or ('--file' in context.args)
-    want_text = ('--text' in context.args)
+    settings = chat_settings.get(update.effective_chat.id)
+    if raw_text.strip().lower().startswith('/codefile') or '--file' in context.args:
+        mode = 'file'
+    elif '--text' in context.args:
+        mode = 'text'
+    else:
+        mode = settings.mode
+    want_file = mode == 'file'
+    want_text = mode == 'text'
     # clean flags from args for prompt
     context.args = [a for a in context.args if a not in ('--file','--text')]
     prompt = " ".join(context.args)
+    prompt_text = f"Write a professional, commented code script for: {prompt}"
 
+    if not await admit_ai_request(update): return
     status = await update.message.reply_text("⚡ *Compiling Code...*", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
 
-    response = await get_ai_response(f"Write a professional, commented code script for: {prompt}")
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
+    # Plain-text answers can be streamed straight into the status message
+    if STREAM_RESPONSES and want_text and not want_file:
+        await stream_ai_reply(update, status, prompt_text, command='code', prefer_image_for_code=False)
+        return
+
+    response = await get_ai_response(prompt_text, command='code', model_pref=settings.model)
+
+    # A refusal or error isn't code: no file, no screenshot
+    if is_ai_failure(response):
+        await send_smart_response(update, response, prefer_image_for_code=False, status=status)
+        return
 
     # If user explicitly asked for file, send document
     if want_file:
@@ -355,31 +2685,31 @@ async def handle_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not code_text:
             code_text = response
         ext_map = {'python':'.py','py':'.py','javascript':'.js','js':'.js','php':'.php'}
-        ext = ext_map.get(lang, '.txt')
+        ext = ext_map.get(lang or heuristic_language(code_text), '.txt')
         filename = f"snippet{ext}"
         bio = BytesIO()
         bio.write(code_text.encode('utf-8'))
         bio.seek(0)
         try:
             await update.message.reply_document(document=bio, filename=filename, caption=get_watermark())
+            await _delete_quietly(status)
             return
         except Exception as e:
             logging.warning(f"Sending file failed: {e}")
 
-    # If user asked for plain text, send as text
+    # If user asked for plain text, edit the status message into the answer
     if want_text or not PYGMENTS_AVAILABLE:
-        await send_smart_response(update, response)
+        await send_smart_response(update, response, status=status)
         return
 
-    # Default: send as colored image
+    # Default: send code blocks as colored images, the explanation as text
     try:
-        img = render_code_image(response, style=STYLE_MAP.get(CHAT_THEMES.get(str(update.effective_chat.id), 'default'), DEFAULT_STYLE))
-        img.seek(0)
-        caption = f"{BOT_NAME} • Code" + get_watermark()
-        await update.message.reply_photo(photo=img, caption=caption)
+        style = STYLE_MAP.get(settings.theme, DEFAULT_STYLE)
+        caption = f"{BOT_NAME} • Code"
+        await send_segmented_response(update, response, style=style, status=status, caption=caption)
     except Exception as e:
         logging.warning(f"Image render failed, falling back to text: {e}")
-        await send_smart_response(update, response)
+        await send_smart_response(update, response, prefer_image_for_code=False, status=status)
 
 async def handle_fix(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Fixes Bugs."""
@@ -390,13 +2720,17 @@ async def handle_fix(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🛠 *Usage:* `/fix (paste code or error)`", parse_mode=ParseMode.MARKDOWN)
         return
 
+    prompt_text = f"Find errors in this code, explain them, and provide the fixed version: {user_input}"
+
+    if not await admit_ai_request(update): return
     status = await update.message.reply_text("🔍 *Debugging System...*", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    
-    response = await get_ai_response(f"Find errors in this code, explain them, and provide the fixed version: {user_input}")
-    
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
-    await send_smart_response(update, response)
+
+    if STREAM_RESPONSES:
+        await stream_ai_reply(update, status, prompt_text, command='fix')
+        return
+
+    response = await get_ai_response(prompt_text, command='fix', model_pref=chat_settings.get(update.effective_chat.id).model)
+    await send_smart_response(update, response, status=status)
 
 async def handle_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Project Planning."""
@@ -407,13 +2741,17 @@ async def handle_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📋 *Usage:* `/plan (project idea)`\nEx: `/plan To-Do App in Python`", parse_mode=ParseMode.MARKDOWN)
         return
 
+    prompt_text = f"Create a step-by-step development plan for: {user_input}. Break it down into Features, Tech Stack, and Logic."
+
+    if not await admit_ai_request(update): return
     status = await update.message.reply_text("🧠 *Constructing Roadmap...*", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    
-    response = await get_ai_response(f"Create a step-by-step development plan for: {user_input}. Break it down into Features, Tech Stack, and Logic.")
-    
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
-    await send_smart_response(update, response)
+
+    if STREAM_RESPONSES:
+        await stream_ai_reply(update, status, prompt_text, command='plan')
+        return
+
+    response = await get_ai_response(prompt_text, command='plan', model_pref=chat_settings.get(update.effective_chat.id).model)
+    await send_smart_response(update, response, status=status)
 
 async def handle_audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Security Audit."""
@@ -424,13 +2762,17 @@ async def handle_audit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🔒 *Usage:* `/audit (paste code)`", parse_mode=ParseMode.MARKDOWN)
         return
 
+    prompt_text = f"Audit this code for security vulnerabilities (SQL Injection, XSS, Logic flaws) and provide a secure version: {user_input}"
+
+    if not await admit_ai_request(update): return
     status = await update.message.reply_text("🛡 *Scanning for Vulnerabilities...*", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    
-    response = await get_ai_response(f"Audit this code for security vulnerabilities (SQL Injection, XSS, Logic flaws) and provide a secure version: {user_input}")
-    
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
-    await send_smart_response(update, response)
+
+    if STREAM_RESPONSES:
+        await stream_ai_reply(update, status, prompt_text, command='audit')
+        return
+
+    response = await get_ai_response(prompt_text, command='audit', model_pref=chat_settings.get(update.effective_chat.id).model)
+    await send_smart_response(update, response, status=status)
 
 async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Prompt Generator."""
@@ -441,13 +2783,17 @@ async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📝 *Usage:* `/prompt (topic)`", parse_mode=ParseMode.MARKDOWN)
         return
 
+    prompt_text = f"Generate a high-quality, detailed AI prompt for: {user_input}. Suitable for ChatGPT or Midjourney."
+
+    if not await admit_ai_request(update): return
     status = await update.message.reply_text("✍️ *Crafting Prompt...*", parse_mode=ParseMode.MARKDOWN)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    
-    response = await get_ai_response(f"Generate a high-quality, detailed AI prompt for: {user_input}. Suitable for ChatGPT or Midjourney.")
-    
-    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status.message_id)
-    await send_smart_response(update, response)
+
+    if STREAM_RESPONSES:
+        await stream_ai_reply(update, status, prompt_text, command='prompt')
+        return
+
+    response = await get_ai_response(prompt_text, command='prompt', model_pref=chat_settings.get(update.effective_chat.id).model)
+    await send_smart_response(update, response, status=status)
 
 async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """General Chat."""
@@ -460,33 +2806,611 @@ async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("💬 *Developer Mode Active.* Ask me anything.", parse_mode=ParseMode.MARKDOWN)
         return
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    response = await get_ai_response(user_text)
-    await send_smart_response(update, response)
+    if not await admit_ai_request(update): return
+    chat_id = str(update.effective_chat.id)
+    async with conversations.lock(chat_id):
+        history = await conversations.history(chat_id)
+
+        if STREAM_RESPONSES:
+            status = await update.message.reply_text("💭", parse_mode=None)
+            response = await stream_ai_reply(update, status, user_text, command='chat', history=history)
+        else:
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+            response = await get_ai_response(user_text, command='chat', history=history, model_pref=chat_settings.get(update.effective_chat.id).model)
+            await send_smart_response(update, response)
+
+        if not is_ai_failure(response):
+            await conversations.add_exchange(chat_id, user_text, response)
+
+async def handle_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Forget the /chat conversation history of this chat."""
+    if not await check_subscription(update, context): return
+    await conversations.clear(str(update.effective_chat.id))
+    await update.message.reply_text("🧹 Conversation memory cleared.")
+
+# ================= 🌐 WEBHOOK SERVER =================
+
+class WebhookServer:
+    """aiohttp server receiving Telegram updates as POSTed JSON.
+
+    Updates are acknowledged immediately and put on a bounded queue that
+    `workers` tasks drain by calling `dispatch(update_json)`. When the queue
+    is full Telegram gets a 503 and retries later. On `stop` the server stops
+    accepting requests and waits up to `drain_timeout` seconds for queued
+    updates to finish.
+    """
+
+    def __init__(self, dispatch, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        self.dispatch = dispatch
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.rejected = 0
+        self._runner = None
+        self._tasks = []
+
+    async def _handle(self, request):
+        from aiohttp import web
+        if self.secret:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, self.secret):
+                return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400, text='invalid JSON')
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logging.warning("Webhook queue full, asking Telegram to retry")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                await self.dispatch(data)
+            except Exception as e:
+                logging.error(f"Update processing error: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        web = await asyncio.to_thread(importlib.import_module, 'aiohttp.web')
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()  # stop accepting new updates first
+            self._runner = None
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Webhook drain timed out with {self.queue.qsize()} updates left")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+async def wait_for_stop_signal():
+    """Block until SIGINT/SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def run_webhook(application, listen: str, port: int, url: str = None):
+    """Serve `application` through WebhookServer until SIGINT/SIGTERM, then drain and shut down."""
+    async def dispatch(data):
+        await application.process_update(Update.de_json(data, application.bot))
+
+    server = WebhookServer(dispatch, listen=listen, port=port)
+    metrics.collectors.append(lambda: [
+        ('bot_webhook_queue_depth', 'gauge', (), server.queue.qsize()),
+        ('bot_webhook_rejected_total', 'counter', (), server.rejected),
+    ])
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    if url:
+        await application.bot.set_webhook(
+            url.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=100,
+        )
+
+    try:
+        await wait_for_stop_signal()
+    finally:
+        logging.info("Shutting down, draining pending updates...")
+        await server.stop()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+# ================= 🧩 SHARDING =================
+
+def shard_key(data: dict) -> int:
+    """Chat id of a raw update (user id for chat-less updates such as inline queries)."""
+    for payload in data.values():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = payload.get('from')
+        if user:
+            return user['id']
+    return data.get('update_id', 0)
+
+
+def is_broadcast_update(data: dict) -> bool:
+    """Membership changes on REQUIRED_CHANNEL concern users whose chats live in
+    any shard, so every worker's subscription cache needs them.
+    """
+    change = data.get('chat_member')
+    if not isinstance(change, dict):
+        return False
+    chat = change.get('chat') or {}
+    return is_required_channel(chat.get('id'), chat.get('username'))
+
+
+class ChatOrderedDispatcher:
+    """Processes updates concurrently across chats but one at a time, in
+    arrival order, within a chat.
+
+    Each update waits for the previous update of its chat before taking one of
+    `concurrency` slots, so a busy chat never holds slots other chats could
+    use. `submit` blocks once `max_pending` updates are unfinished.
+    """
+
+    def __init__(self, process, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = SHARD_MAX_PENDING):
+        self.process = process
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pending = asyncio.Semaphore(max_pending)
+        self._tails = {}  # chat key -> task of that chat's latest update
+        self._tasks = set()
+
+    async def submit(self, key, data):
+        await self._pending.acquire()
+        task = asyncio.create_task(self._run(key, data, self._tails.get(key)))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, data, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            async with self._slots:
+                await self.process(data)
+        except Exception as e:
+            logging.error(f"Update processing error: {e}")
+        finally:
+            self._pending.release()
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+    async def drain(self, timeout: float):
+        if self._tasks:
+            _, unfinished = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if unfinished:
+                logging.warning(f"Shard drain timed out with {len(unfinished)} updates left")
+
+
+def _shard_worker_main(index: int, workers: int, updates, stats, token: str, base_url: str = None):
+    """Process entry point of shard worker `index` (started by ShardSupervisor)."""
+    # Ctrl-C reaches the whole process group; the supervisor decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_shard_worker(index, workers, updates, stats, token, base_url))
+
+
+async def _run_shard_worker(index: int, workers: int, updates, stats, token: str, base_url: str = None):
+    global admission, GROQ_RPM_BUDGET, GROQ_TPM_BUDGET
+    # The Groq quota is shared by every shard
+    GROQ_RPM_BUDGET /= workers
+    GROQ_TPM_BUDGET /= workers
+    admission = AdmissionController()
+    llm.on_usage = admission.record_usage
+    router.on_extra_attempt = admission.charge
+
+    application = build_application(token, base_url=base_url)
+    application.bot_data['shard'] = index
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    async def process(data):
+        await application.process_update(Update.de_json(data, application.bot))
+
+    dispatcher = ChatOrderedDispatcher(process)
+    loop = asyncio.get_running_loop()
+
+    def read_updates():
+        # Blocking reads happen on this thread; waiting on submit() here is what
+        # pushes back on the ingress when the worker is saturated
+        while True:
+            data = updates.get()
+            if data is None:
+                return
+            asyncio.run_coroutine_threadsafe(dispatcher.submit(shard_key(data), data), loop).result()
+
+    async def report_metrics():
+        while True:
+            await asyncio.sleep(SHARD_METRICS_INTERVAL)
+            try:
+                stats.put_nowait((index, metrics.snapshot()))
+            except queue.Full:
+                pass
+
+    reporter = asyncio.create_task(report_metrics())
+    logging.info(f"Shard {index}/{workers} ready")
+    try:
+        await asyncio.to_thread(read_updates)
+    finally:
+        await dispatcher.drain(WEBHOOK_DRAIN_TIMEOUT)
+        reporter.cancel()
+        stats.put((index, metrics.snapshot()))
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+async def poll_updates(token: str, dispatch, base_url: str = None, timeout: int = POLL_TIMEOUT):
+    """Long-poll getUpdates with a plain HTTP client and hand each raw update to `dispatch`.
+
+    The sharded ingress only needs the chat id, so updates are never turned
+    into telegram.Update objects here.
+    """
+    base = f"{base_url or 'https://api.telegram.org/bot'}{token}"
+    offset = None
+    async with httpx.AsyncClient(timeout=timeout + 10) as client:
+        await client.post(f"{base}/deleteWebhook")
+        while True:
+            try:
+                response = await client.post(f"{base}/getUpdates", json={
+                    'offset': offset, 'timeout': timeout, 'allowed_updates': Update.ALL_TYPES})
+                body = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                logging.warning(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if not body.get('ok'):
+                retry_after = body.get('parameters', {}).get('retry_after', 1)
+                logging.warning(f"getUpdates refused: {body.get('description')}")
+                await asyncio.sleep(retry_after)
+                continue
+            for data in body['result']:
+                offset = data['update_id'] + 1
+                await dispatch(data)
+
+
+class ShardSupervisor:
+    """Runs `workers` bot processes and routes every update to one of them by chat.
+
+    Worker i owns the chats with `chat_id % workers == i`, so a chat's
+    conversation memory, rate limits and update order all live in one process.
+    Each worker reads from its own bounded queue; a full queue makes the ingress
+    wait. A worker that dies is started again (updates still queued for it are
+    lost), and `restart` replaces one gracefully after it has drained. Workers send metrics snapshots
+    that this process serves, merged, on the metrics endpoint.
+    """
+
+    def __init__(self, workers: int, token: str = TELEGRAM_BOT_TOKEN, base_url: str = None):
+        self.workers = workers
+        self.token = token
+        self.base_url = base_url
+        # spawn, not fork: the parent already runs an event loop and threads
+        self._ctx = multiprocessing.get_context('spawn')
+        self.queues = [self._ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(workers)]
+        self.stats = self._ctx.Queue(workers * 4)
+        self.processes = [None] * workers
+        self.dispatched = [0] * workers
+        self.restarts = 0
+        self._restarting = set()
+        self._stopping = False
+        self._tasks = []
+
+    def _spawn(self, index: int):
+        process = self._ctx.Process(
+            target=_shard_worker_main, name=f"shard-{index}",
+            args=(index, self.workers, self.queues[index], self.stats, self.token, self.base_url))
+        process.start()
+        self.processes[index] = process
+
+    async def _put(self, index: int, data):
+        try:
+            self.queues[index].put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(self.queues[index].put, data)
+
+    async def dispatch(self, data: dict):
+        if is_broadcast_update(data):
+            targets = range(self.workers)
+        else:
+            targets = [shard_key(data) % self.workers]
+        for index in targets:
+            await self._put(index, data)
+            self.dispatched[index] += 1
+
+    def _replace_queue(self, index: int) -> int:
+        """Give shard `index` a new queue and return how many updates the old one still held.
+
+        A worker killed inside queue.get() still holds the queue's read lock,
+        so its successor can't use the old queue; what was left is lost.
+        """
+        old = self.queues[index]
+        self.queues[index] = self._ctx.Queue(SHARD_QUEUE_SIZE)
+        old.cancel_join_thread()
+        return old.qsize()
+
+    async def restart(self, index: int):
+        """Replace worker `index` after it has finished the updates it already took,
+        terminating it if that takes longer than the drain timeout.
+        """
+        self._restarting.add(index)
+        try:
+            process = self.processes[index]
+            try:
+                await asyncio.to_thread(self.queues[index].put, None, True, WEBHOOK_DRAIN_TIMEOUT)
+            except queue.Full:
+                pass  # the worker is stuck; it gets terminated below
+            await asyncio.to_thread(process.join, WEBHOOK_DRAIN_TIMEOUT + 10)
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+                await asyncio.to_thread(process.join)
+                dropped = self._replace_queue(index)
+                logging.warning(f"Shard {index} restarted with {dropped} queued updates dropped")
+            self.restarts += 1
+            self._spawn(index)
+        finally:
+            self._restarting.discard(index)
+
+    async def rolling_restart(self):
+        for index in range(self.workers):
+            await self.restart(index)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self.processes):
+                if self._stopping or index in self._restarting or process.is_alive():
+                    continue
+                dropped = self._replace_queue(index)
+                logging.error(f"Shard {index} exited with code {process.exitcode}, restarting "
+                              f"({dropped} queued updates dropped)")
+                self.restarts += 1
+                await asyncio.sleep(SHARD_RESTART_DELAY)
+                if not self._stopping:
+                    self._spawn(index)
+
+    async def _collect(self):
+        while True:
+            item = await asyncio.to_thread(self.stats.get)
+            if item is None:
+                return
+            index, snapshot = item
+            metrics.remote[str(index)] = snapshot
+
+    def collect_metrics(self):
+        for index, count in enumerate(self.dispatched):
+            labels = (('shard', str(index)),)
+            yield 'bot_shard_dispatched_total', 'counter', labels, count
+            yield 'bot_shard_queue_depth', 'gauge', labels, self.queues[index].qsize()
+        yield 'bot_shard_restarts_total', 'counter', (), self.restarts
+
+    async def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        # This process handles no updates itself; only the shards' numbers matter
+        metrics.collectors = [self.collect_metrics]
+        self._tasks = [asyncio.create_task(self._watch()), asyncio.create_task(self._collect())]
+        await metrics.start_server()
+        logging.info(f"Started {self.workers} shard workers")
+
+    async def stop(self):
+        self._stopping = True
+        self._tasks[0].cancel()
+        for q in self.queues:
+            try:
+                await asyncio.to_thread(q.put, None, True, WEBHOOK_DRAIN_TIMEOUT)
+            except queue.Full:
+                pass  # the worker is stuck; it gets terminated below
+        deadline = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT + 10
+        for process, q in zip(self.processes, self.queues):
+            await asyncio.to_thread(process.join, max(0.1, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop in time, terminating")
+                process.terminate()
+                q.cancel_join_thread()  # nobody will read what is left
+        self.stats.put(None)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await metrics.stop_server()
+
+
+async def run_sharded(workers: int, webhook: bool = False, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                      url: str = None, token: str = TELEGRAM_BOT_TOKEN, base_url: str = None):
+    """Ingress + supervisor: receive updates (polling or webhook) and fan them out
+    to `workers` shard processes until SIGINT/SIGTERM. SIGHUP restarts the
+    workers one at a time.
+    """
+    supervisor = ShardSupervisor(workers, token=token, base_url=base_url)
+    await supervisor.start()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(supervisor.rolling_restart()))
+
+    server = poller = None
+    if webhook:
+        # A single dispatching task keeps updates in arrival order
+        server = WebhookServer(supervisor.dispatch, listen=listen, port=port, workers=1)
+        await server.start()
+        if url:
+            async with httpx.AsyncClient() as client:
+                await client.post(f"{base_url or 'https://api.telegram.org/bot'}{token}/setWebhook", json={
+                    'url': url.rstrip('/') + WEBHOOK_PATH, 'secret_token': WEBHOOK_SECRET,
+                    'allowed_updates': Update.ALL_TYPES, 'max_connections': 100})
+    else:
+        poller = asyncio.create_task(poll_updates(token, supervisor.dispatch, base_url=base_url))
+
+    try:
+        await wait_for_stop_signal()
+    finally:
+        logging.info("Shutting down shards...")
+        if server is not None:
+            await server.stop()
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await supervisor.stop()
 
 # ================= 🚀 MAIN LOOP =================
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Add Handlers
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('code', handle_code))
-    application.add_handler(CommandHandler('fix', handle_fix))
-    application.add_handler(CommandHandler('chat', handle_chat))
-    application.add_handler(CommandHandler('codeimg', handle_code_image))
-    application.add_handler(CommandHandler('theme', handle_theme))
+async def warm_up():
+    """Pay the first-request costs in the background: import groq and build its
+    client, start the render workers and load fonts, ImageFormatter and
+    WARMUP_LEXERS in them. Logs the startup report when done.
+    """
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(importlib.import_module, 'groq')
+        llm.client
+        if PYGMENTS_AVAILABLE:
+            await render_pool.warm_up()
+    except Exception as e:
+        logging.warning(f"Warm-up incomplete: {e}")
+    startup.record('warmup', time.perf_counter() - started)
+    logging.info(startup.report())
+
+
+_background_tasks = set()
+
+
+def run_in_background(coro, name: str):
+    """Start `coro` as a task we keep a reference to; its failure is logged."""
+    def done(task):
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"{name} failed: {task.exception()}")
+
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(done)
+    return task
+
+
+async def on_startup(application):
+    """Load chat settings, then start the metrics endpoint and the warm-up in
+    the background so the bot starts taking updates right away. Shard workers
+    report to the supervisor instead of serving metrics.
+    """
+    await chat_settings.start()
+    startup.mark('initialize')
+    startup.record('ready', time.perf_counter() - startup.started)
+    if 'shard' not in application.bot_data:
+        run_in_background(metrics.start_server(), 'Metrics server')
+    if WARMUP_ENABLED:
+        run_in_background(warm_up(), 'Warm-up')
+    else:
+        logging.info(startup.report())
+
+async def on_shutdown(application):
+    """Release shared network and worker resources when the bot stops."""
+    await metrics.stop_server()
+    await llm.aclose()
+    render_pool.shutdown()
+    response_cache.close()
+    conversations.close()
+    await chat_settings.close()
+
+
+def build_application(token: str = TELEGRAM_BOT_TOKEN, base_url: str = None):
+    """Create the bot Application with every handler registered."""
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+
+    # Add Handlers (each wrapped for per-command latency metrics)
+    track = metrics.instrument
+    application.add_handler(CommandHandler('start', track('start', start)))
+    application.add_handler(CommandHandler('code', track('code', handle_code)))
+    application.add_handler(CommandHandler('fix', track('fix', handle_fix)))
+    application.add_handler(CommandHandler('chat', track('chat', handle_chat)))
+    application.add_handler(CommandHandler('codeimg', track('codeimg', handle_code_image)))
+    application.add_handler(CommandHandler('theme', track('theme', handle_theme)))
+    application.add_handler(CommandHandler('mode', track('mode', handle_mode)))
+    application.add_handler(CommandHandler('model', track('model', handle_model)))
+    application.add_handler(CommandHandler('reset', track('reset', handle_reset)))
     
     # New Advanced Handlers
-    application.add_handler(CommandHandler('plan', handle_plan))
-    application.add_handler(CommandHandler('audit', handle_audit))
-    application.add_handler(CommandHandler('prompt', handle_prompt))
+    application.add_handler(CommandHandler('plan', track('plan', handle_plan)))
+    application.add_handler(CommandHandler('audit', track('audit', handle_audit)))
+    application.add_handler(CommandHandler('prompt', track('prompt', handle_prompt)))
     
     # Text Handler
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_chat))
+    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), track('text', handle_chat)))
+
+    # Channel joins/leaves (bot must be admin of REQUIRED_CHANNEL to receive these)
+    application.add_handler(ChatMemberHandler(handle_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    startup.mark('build')
+    return application
+
+
+startup.mark('import')
 
+
+def main():
+    parser = argparse.ArgumentParser(description=f"{BOT_NAME} Telegram bot")
+    parser.add_argument('--webhook', action='store_true', help='receive updates via webhook instead of long polling')
+    parser.add_argument('--listen', default=WEBHOOK_LISTEN, help='webhook listen address')
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT, help='webhook listen port')
+    parser.add_argument('--webhook-url', default=WEBHOOK_URL, help='public base URL to register with Telegram')
+    parser.add_argument('--workers', type=int, default=SHARD_WORKERS,
+                        help='run N worker processes sharded by chat (0 = single process)')
+    args = parser.parse_args()
+
+    console = get_console()
     if console:
         console.print(f"✅ {BOT_NAME} System Online...", style="bold green")
     else:
         print(f"✅ {BOT_NAME} System Online...")
-    application.run_polling()
+    if args.workers > 0:
+        asyncio.run(run_sharded(args.workers, args.webhook, args.listen, args.port, args.webhook_url))
+    elif args.webhook:
+        asyncio.run(run_webhook(build_application(), args.listen, args.port, args.webhook_url))
+    else:
+        build_application().run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == '__main__':
+    main()